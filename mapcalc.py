@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import sys
+import re
+import glob
+import argparse
+import zxutils
+
+
+# Parsing arguments.
+usage = 'mapcalc.py expression... [-o outmapfile] [-r] [-s]'
+usage += "\n\t             Evaluates set expression over execution maps in FUSE format."
+usage += "\n\texpression - operands and operators separated by spaces (quote the expression to keep shell away from it):"
+usage += "\n\t             file.map      - execution map, wildcards give the union of all matching maps"
+usage += "\n\t             all(file...)  - intersection of maps (wildcards allowed), any(file...) - union of maps"
+usage += "\n\t             A | B, A ^ B  - union, symmetric difference"
+usage += "\n\t             A & B, A - B  - intersection, difference (addresses in A but not in B)"
+usage += "\n\t             ~A            - complement, parentheses group subexpressions"
+usage += "\n\t             precedence from the highest: ~, then & and -, then ^, then |"
+usage += "\n\t             maps are loaded one by one and folded, so any number of files could be used"
+usage += "\n\t-o         - save resulting map into file"
+usage += "\n\t-r         - print resulting map as address ranges (default if neither -o nor -s is specified)"
+usage += "\n\t-s         - print number of resulting addresses and their coverage of memory and RAM"
+usage += "\n\tExample: mapcalc.py 'build-b/*.map - build-a/*.map' -r"
+
+parser = argparse.ArgumentParser(add_help = False, usage = usage)
+parser.add_argument('expression', nargs = '+')
+parser.add_argument('-o')
+parser.add_argument('-r', action = 'store_true')
+parser.add_argument('-s', action = 'store_true')
+
+
+_binary = [('|',), ('^',), ('&', '-')] # operators by precedence, the lowest first
+_tokens = re.compile(r'[()~]|[^\s()~]+')
+
+
+class _Parser:
+    """Recursive descent evaluator - operands are loaded when they are reached, so only intermediate results are kept."""
+
+    def __init__(self, expression):
+        self.tokens = _tokens.findall(expression)
+        self.pos = 0
+
+
+    def parse(self):
+        if not self.tokens:
+            sys.exit('Expression is empty.')
+
+        result = self._binary(0)
+        if self.pos < len(self.tokens):
+            sys.exit('Unexpected "%s" in expression.' % self.tokens[self.pos])
+
+        return result
+
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            sys.exit('Unexpected end of expression.')
+
+        self.pos += 1
+        return token
+
+
+    def _expect(self, token):
+        if self._next() != token:
+            sys.exit('"%s" expected in expression.' % token)
+
+
+    def _binary(self, level):
+        if level == len(_binary):
+            return self._unary()
+
+        result = self._binary(level + 1)
+        while self._peek() in _binary[level]:
+            op = self._next()
+            right = self._binary(level + 1)
+
+            if op == '|':
+                result |= right
+            elif op == '^':
+                result ^= right
+            elif op == '&':
+                result &= right
+            else:
+                result -= right
+
+        return result
+
+
+    def _unary(self):
+        token = self._next()
+
+        if token == '~':
+            return ~self._unary()
+
+        if token == '(':
+            result = self._binary(0)
+            self._expect(')')
+            return result
+
+        if token in ('all', 'any') and self._peek() == '(':
+            self._next()
+            patterns = []
+            while self._peek() != ')':
+                patterns.append(self._next())
+            self._next()
+
+            maps = _load_maps(patterns)
+            return zxutils.map.intersect(maps) if token == 'all' else zxutils.map.merge(maps)
+
+        if token in ('|', '^', '&', '-', ')'):
+            sys.exit('Operand expected instead of "%s" in expression.' % token)
+
+        return zxutils.map.merge(_load_maps([token]))
+
+
+def _load_maps(patterns):
+    """Yields maps of all files matching patterns loading them one by one."""
+
+    if not patterns:
+        sys.exit('No files specified in expression.')
+
+    for pattern in patterns:
+        filenames = sorted(glob.glob(pattern)) if any(c in pattern for c in '*?[') else [pattern]
+        if not filenames:
+            sys.exit('No files match "%s".' % pattern)
+
+        for filename in filenames:
+            yield zxutils.map.load(filename)
+
+
+_ram = zxutils.map.Bitmap.from_flags([addr >= 0x4000 for addr in range(0x10000)])
+
+
+def print_ranges(map):
+    for org, end in map.ranges():
+        if end - org > 1:
+            print('#%04X-#%04X' % (org, end - 1))
+        else:
+            print('#%04X' % org)
+
+
+def print_stats(map):
+    count = map.count()
+    ram_count = (map & _ram).count()
+
+    print('%d address(es), %.2f%% of memory, %.2f%% of RAM (%d).' % (count, 100.0 * count / 0x10000, 100.0 * ram_count / 0xC000, ram_count))
+
+
+def main():
+    args = parser.parse_args()
+
+    result = _Parser(' '.join(args.expression)).parse()
+
+    if args.o:
+        zxutils.map.save(args.o, result)
+
+    if args.r or not (args.o or args.s):
+        print_ranges(result)
+
+    if args.s:
+        print_stats(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,9 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-from __future__ import print_function
 import sys
 import os
 import argparse
+import zxutils
 
 
 def error(msg):
@@ -15,14 +15,16 @@ def warning(msg):
 
 # Parsing arguments.
 
-usage= 'profile_analyse.py profile labels [scope] [-l|--local] [-r|--rom] [-m|--macro] [-a|--all]'
+usage= 'profile_analyse.py profile labels [scope] [-l|--local] [-r|--rom] [-m|--macro] [-a|--all] [-c|--cache]'
 usage += "\n\tprofile     - profiler log generated by FUSE emulator"
 usage += "\n\tlabels      - labels list in UnrealSpeccy format (can be generated by SjASMPlus)"
+usage += "\n\t              blank lines are skipped, other invalid lines are reported to <stderr> and skipped"
 usage += "\n\tscope       - limits all calculations to scope[.*] labels"
 usage += "\n\t-l, --local - no not exclude local labels"
 usage += "\n\t-r, --rom   - no not exclude labels that are below 0x4000 (usually theese are not real labels but constants)"
 usage += "\n\t-m, --macro - no not exclude labels inside MACRO (usually they just litter labels namespace)"
 usage += "\n\t-a, --all   - use all labels from list (equivalent to -lrm)"
+usage += "\n\t-c, --cache - cache parsed labels list until it's changed (cache is kept in ~/.cache/zxutils or $ZXUTILS_CACHE_DIR)"
 
 parser = argparse.ArgumentParser(add_help = False, usage = usage)
 parser.add_argument('profile')
@@ -32,6 +34,7 @@ parser.add_argument('-l', '--local', action = 'store_true')
 parser.add_argument('-r', '--rom', action = 'store_true')
 parser.add_argument('-m', '--macro', action = 'store_true')
 parser.add_argument('-a', '--all', action = 'store_true')
+parser.add_argument('-c', '--cache', action = 'store_true')
 args = parser.parse_args()
 
 for filename in args.profile, args.labels:
@@ -79,59 +82,41 @@ with open(args.profile) as f:
 
 # Loading labels.
 
-labels = {}
+labels = zxutils.labels.create()
 
-with open(args.labels) as f:
-    n = 0
-    for line in f:
-        n += 1
-        try:
-            line = line.strip()
+entries, errors = zxutils.labels.parse(args.labels, args.cache)
 
-            addr, label = line.split()
-            page, offset = [part.strip() for part in addr.split(':')]
+for n, line in errors:
+    warning('Incorrect line #%d (\"%s\") in file \"%s\" skipped.' % (n, line, args.labels))
 
-            page = ('07', '05', '02', '00').index(page) if page else 0
-            offset = int(offset, 16)
+for addr, label in entries:
+    if args.rom or addr >= 0x4000:
+        labels.add(addr, label)
 
-            if not 0 <= offset < 0x4000:
-                raise ValueError()
 
-            addr = page * 0x4000 + offset
+# Filtering out macro and local labels (by name - the same label could be at several addresses).
 
-            if not args.rom and addr < 0x4000:
-                continue
-            if not args.macro and '>' in label:
-                continue
+index = zxutils.labels.LabelIndex(labels)
 
-            if addr not in labels:
-                labels[addr] = [label]
-            else:
-                labels[addr].append(label)
-        except ValueError:
-            warning('Incorrect line #%d (\"%s\") in file \"%s\" skipped.' % (n, line, args.labels))
-
-
-# Filtering out local labels.
+if not args.macro:
+    for label in list(index.macros):
+        index.remove(label)
 
 if not args.local:
-    labels_list = [l for ll in labels.values() for l in ll if l != args.scope]
-    new_labels = {}
+    local_labels = [label for label in index if index.is_local(label) and zxutils.labels.get_parent(label) != args.scope and label != args.scope]
+    for label in local_labels:
+        index.remove(label)
 
-    for addr in labels:
-        ll = [l for l in labels[addr] if '.' not in l or '.'.join(l.split('.')[:-1]) not in labels_list or l == args.scope]
-        if ll:
-            new_labels[addr] = ll
-
-    labels = new_labels
+for addr in labels.addrs():
+    labels[addr] = [label for label in labels[addr] if label in index]
 
 
 # Adding ROM and RAM start labels.
 
 if 0 not in labels:
-    labels[0] = ['ROM']
+    labels.add(0, 'ROM')
 if 0x4000 not in labels:
-    labels[0x4000] = ['RAM']
+    labels.add(0x4000, 'RAM')
 
 
 # Calculating time spent between labels.
@@ -139,10 +124,12 @@ if 0x4000 not in labels:
 times = {}
 total = 0
 
-addrs = sorted(labels)
+scope_labels = set(index.find(args.scope)) if args.scope else None
+
+addrs = labels.addrs()
 for i in range(len(addrs)):
     if args.scope:
-        if not any([label == args.scope or label.startswith(args.scope + '.') for label in labels[addrs[i]]]):
+        if not any([label in scope_labels for label in labels[addrs[i]]]):
             continue
 
     beg = addrs[i]
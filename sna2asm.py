@@ -1,8 +1,9 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-from __future__ import print_function
 import sys
 import os
+import glob
+import time
 import argparse
 import zxutils
 
@@ -20,9 +21,10 @@ def _try_int(s, limits = None):
 
 
 # Parsing arguments.
-usage = 'sna2asm.py filename [-s [entrypoint_1...]] [-m mapfile_1...] [-l labelsfile] [-a [none|code|data|all]] [-om outmapfile] [-ol outlabelsfile]'
+usage = 'sna2asm.py filename_1... [-s [entrypoint_1...]] [-m mapfile_1...] [-l labelsfile] [-a [none|code|data|all]] [-b bank] [-f [threshold]] [-c] [-om outmapfile] [-ol outlabelsfile] [-d [outdir]] [-j jobs]'
 usage += "\n\t           Disassembles snapshot <filename> and prints generated assembler program to <stdout>."
 usage += "\n\tfilename - shapshot in SNA format (both 48k and 128k formats are supported)"
+usage += "\n\t           in batch mode (see -d) - any number of snapshots, wildcards or @manifest files listing one snapshot per line"
 usage += "\n\t-s       - entry point(s) to start disassembly from (each could be a number in [0x4000, 0xFFFF] or PC)"
 usage += "\n\t           if option is omitted - PC value from shapshot is used"
 usage += "\n\t           if option specified without a value - only map file(s) used"
@@ -32,124 +34,344 @@ usage += "\n\t-l       - labels in UnrealSpeccy format (see README.md for detail
 usage += "\n\t-a       - generate address prefixes for code and/or data lines, can be 'none', 'code', 'data' or 'all'"
 usage += "\n\t           if option is omitted - 'code' value is used"
 usage += "\n\t           if option specified without a value - 'all' value is used"
+usage += "\n\t-b       - 128k snapshots only: RAM bank (0-7) paged at #C000 for disassembly"
+usage += "\n\t           if option is omitted - bank paged by port #7FFD value from snapshot is used"
+usage += "\n\t           'all' - the paged bank as above, then every other bank in its own section (PAGE n, MODULE bankn, ORG #C000)"
+usage += "\n\t           traced from jumps of #4000-#BFFF code and map entries into #C000-#FFFF, the analysis of banks 5 and 2"
+usage += "\n\t           is shared by all banks (-om and -ol save the map and labels of the paged bank configuration)"
+usage += "\n\t-f       - dump runs of at least <threshold> identical data bytes as DEFS (16 if specified without a value)"
+usage += "\n\t-c       - cache code analysis results and resume from them when the same snapshot is disassembled again"
+usage += "\n\t           with the same entry points followed by more ones (or by map files), cache parsed labels file until it's changed"
+usage += "\n\t           (cache is kept in ~/.cache/zxutils or $ZXUTILS_CACHE_DIR)"
 usage += "\n\t-om      - save resulting exection map into file"
 usage += "\n\t-ol      - save generated labels into file"
+usage += "\n\t-d       - batch mode: disassembles every snapshot into <name>.asm, <name>.map & <name>.l files in outdir"
+usage += "\n\t           if option specified without a value - next to the snapshots"
+usage += "\n\t           snapshot whose output files would overwrite ones of a previous snapshot with the same name fails"
+usage += "\n\t           timing and failure of every snapshot are reported to <stderr>"
+usage += "\n\t-j       - number of worker processes: in batch mode - snapshots disassembled at once (by default - number of CPUs),"
+usage += "\n\t           otherwise - processes rendering code blocks and data regions of the listing (by default - 1)"
 usage += "\n\t           See README.md for more information and examples."
 
 parser = argparse.ArgumentParser(add_help = False, usage = usage)
-parser.add_argument('filename')
+parser.add_argument('filename', nargs = '+')
 parser.add_argument('-s', nargs = '*', default = ['PC'])
 parser.add_argument('-m', nargs = '+')
 parser.add_argument('-l')
 parser.add_argument('-a', nargs = '?', choices = ['none', 'code', 'data', 'all'], default = 'data')
+parser.add_argument('-b')
+parser.add_argument('-f', nargs = '?', const = '16')
+parser.add_argument('-c', action = 'store_true')
 parser.add_argument('-om')
 parser.add_argument('-ol')
-args = parser.parse_args()
+parser.add_argument('-d', nargs = '?', const = '')
+parser.add_argument('-j')
 
 
-# Loading.
-sna          = zxutils.sna.load(args.filename)
-entry_points = [sna['pc'] if arg.upper() == 'PC' else _try_int(arg, (0, 0x10000)) for arg in args.s]
-map          = zxutils.map.merge([zxutils.map.load(m) for m in args.m]) if args.m else None
-labels       = zxutils.labels.load(args.l) if args.l else zxutils.labels.create()
-print_addr   = args.a or 'all'
+def disassemble(filename, args, out_map = None, out_labels = None, file = None, jobs = None):
+    """Disassembles snapshot writing assembler program to file (stdout by default), saves execution map & labels if requested.
 
+    With jobs > 1 listing regions are rendered by that many worker processes.
+    """
 
-# Analyzing code.
-analyzer = zxutils.CodeAnalyzer(sna['ram'])
+    # Loading.
+    all_banks    = args.b == 'all'
+    snapshot     = zxutils.sna.Snapshot(filename)
+    memory       = snapshot.get_memory(_try_int(args.b, (0, 8)) if args.b and not all_banks else None)
+    entry_points = [snapshot.pc if arg.upper() == 'PC' else _try_int(arg, (0, 0x10000)) for arg in args.s]
+    map          = zxutils.map.merge([zxutils.map.load(m) for m in args.m]) if args.m else None
+    labels       = zxutils.labels.load(args.l, args.c) if args.l else zxutils.labels.create()
 
-for ep in entry_points:
-    analyzer.add_entry_point(ep)
+    if None in entry_points:
+        sys.exit('Can\'t use PC as entry point - SP is out of RAM in file "%s".' % filename)
 
-if map:
-    for addr in range(0x10000):
-        if map[addr] and not analyzer.map[addr]:
-            analyzer.add_entry_point(addr)
+    if all_banks and snapshot.type == 48:
+        sys.exit('Can\'t disassemble all banks of 48k snapshot "%s".' % filename)
 
-blocks = analyzer.get_code_blocks()
-jumps = analyzer.get_jumps()
+    analyzer = _analyze(memory, entry_points, map, args.c)
+    banks = _analyze_banks(snapshot, analyzer, map) if all_banks else []
+    blocks = analyzer.get_code_blocks()
 
-jumps_reverted = [[] for i in range(0x10000)]
-for jump_from in jumps:
-    jump_to = jumps[jump_from]
-    if jump_to is not None:
-        jumps_reverted[jump_to].append(jump_from)
+    bank_user_labels = [(addr, list(addr_labels)) for addr, addr_labels in labels.items(0xC000)]
 
+    _generate_labels(labels, analyzer, blocks)
 
-# Generating labels.
-for addr in range(0x10000):
-    labels[addr] = [label for label in labels[addr] if label.find('%04X' % addr) == -1]
+    sections = []
+    for bank, bank_analyzer in banks:
+        bank_labels = zxutils.labels.create()
+        for addr, addr_labels in labels.items(0, 0xC000) + bank_user_labels:
+            bank_labels[addr] = addr_labels
 
-for org, end in blocks:
-    if labels[org]:
-        proc_name = labels[org][0]
-    else:
-        proc_name = 'proc%04X' % org
-        labels[org].append(proc_name)
-
-    for addr in range(org + 1, end):
-        if not labels[addr]:
-            if jumps_reverted[addr]:
-                if analyzer.map[addr]:
-                    if all([org <= caller < end for caller in jumps_reverted[addr]]):
-                        prefix = 'local'
+        bank_blocks = [block for block in bank_analyzer.get_code_blocks() if block[0] >= 0xC000]
+        _generate_labels(bank_labels, bank_analyzer, bank_blocks, 0xC000)
+        sections.append((bank, bank_analyzer, bank_labels, bank_blocks))
+
+    _print_program(snapshot, memory, labels, analyzer, blocks, entry_points, args.a or 'all', _try_int(args.f, (2, 0x10001)) if args.f else None, jobs, file, sections)
+
+    # Saving.
+    if out_map:
+        zxutils.map.save(out_map, analyzer.get_exec_map())
+
+    if out_labels:
+        zxutils.labels.save(out_labels, labels)
+
+
+def _analyze(memory, entry_points, map, use_cache):
+    analyzer = zxutils.CodeAnalyzer(memory)
+
+    traced, map_traced = analyzer.load_cache(entry_points, map) if use_cache else (0, False)
+
+    analyzer.add_entry_points(entry_points[traced:])
+
+    if map and not map_traced:
+        analyzer.add_entry_points(map)
+
+    if use_cache and (traced < len(entry_points) or map and not map_traced):
+        analyzer.save_cache(entry_points, map)
+
+    return analyzer
+
+
+def _analyze_banks(snapshot, analyzer, map):
+    """Traces every bank but 5, 2 and the paged one at #C000 from jumps of #4000-#BFFF code and map entries into #C000-#FFFF,
+    returns list of (bank, CodeAnalyzer). Banks start from the analysis of #4000-#BFFF, code they reach there is traced by analyzer.
+    """
+
+    paged_memory = snapshot.get_banks()
+
+    targets = sorted(set([target for addr, target in analyzer.get_jumps().items() if addr < 0xC000 and target is not None and target >= 0xC000]))
+    bank_map = zxutils.map.Bitmap.from_addrs([addr for addr in map if addr >= 0xC000]) if map else None
+
+    banks = []
+    for bank in range(8):
+        if bank not in (5, 2, paged_memory.paged_bank):
+            bank_analyzer = analyzer.fork(paged_memory.get_address_space(bank))
+            bank_analyzer.add_entry_points(targets)
+            if bank_map:
+                bank_analyzer.add_entry_points(bank_map)
+            banks.append((bank, bank_analyzer))
+
+    shared = set()
+    for bank, bank_analyzer in banks:
+        for addr, target in bank_analyzer.get_jumps().items():
+            if addr >= 0xC000 and target is not None and 0x4000 <= target < 0xC000 and analyzer.map[target] == zxutils.code_analysis.UNKNOWN:
+                shared.add(target)
+
+    analyzer.add_entry_points(sorted(shared))
+
+    return banks
+
+
+def _generate_labels(labels, analyzer, blocks, start = None):
+    # start limits labels replaced by generated ones to [start, #10000) - for banks paged at #C000.
+    cfg = analyzer.get_cfg()
+
+    for addr in labels.addrs(start or 0):
+        labels[addr] = [label for label in labels[addr] if label.find('%04X' % addr) == -1]
+
+    for org, end in blocks:
+        if labels[org]:
+            proc_name = labels[org][0]
+        else:
+            proc_name = 'proc%04X' % org
+            labels.add(org, proc_name)
+
+        for addr in range(org + 1, end):
+            if not labels[addr]:
+                callers = cfg.get_callers(addr)
+                if callers:
+                    if analyzer.map[addr] == zxutils.code_analysis.OPCODE:
+                        if all([org <= caller < end for caller in callers]):
+                            prefix = 'local'
+                        else:
+                            prefix = 'entry'
                     else:
-                        prefix = 'entry'
-                else:
-                    prefix = 'broken'
-                labels[addr].append(proc_name + '.' + prefix + '%04X' % addr)
+                        prefix = 'broken'
+                    labels.add(addr, proc_name + '.' + prefix + '%04X' % addr)
 
-for i in range(len(blocks) + 1):
-    org = blocks[i - 1][1] if i > 0 else 0x4000
-    end = blocks[i][0] if i < len(blocks) else 0x10000
-    if org < end and not labels[org]:
-        labels[org].append('data%04X_size_%d_bytes' % (org, end - org))
+    for i in range(len(blocks) + 1):
+        org = blocks[i - 1][1] if i > 0 else start or 0x4000
+        end = blocks[i][0] if i < len(blocks) else 0x10000
+        if org < end and not labels[org]:
+            labels.add(org, 'data%04X_size_%d_bytes' % (org, end - org))
 
 
-# Disassembling & printing.
-disassembler = zxutils.Disassembler(sna['ram'], labels, print_code_addr = print_addr in ['all', 'code'], print_data_addr = print_addr in ['all', 'data'])
+def _get_regions(blocks, start = 0x4000):
+    # Code blocks and data regions between them - list of (org, end, is_code) covering [start, #10000).
+    regions = []
+    addr = start
+    for org, end in blocks:
+        if addr < org:
+            regions.append((addr, org, False))
+        regions.append((org, end, True))
+        addr = end
+    if addr < 0x10000:
+        regions.append((addr, 0x10000, False))
 
-print(disassembler.tab + 'DEVICE ZXSPECTRUM%d, #%04X' % (sna['type'], min(sna['sp'] + 3, 0xFFFF)))
+    return regions
+
+
+def _print_program(snapshot, memory, labels, analyzer, blocks, entry_points, print_addr, defs_threshold = None, jobs = None, file = None, sections = ()):
+    out = zxutils.Output(file)
+    print_code_addr, print_data_addr = print_addr in ['all', 'code'], print_addr in ['all', 'data']
+    disassembler = zxutils.Disassembler(memory, labels, print_code_addr = print_code_addr, print_data_addr = print_data_addr, cache = analyzer.cache, output = out, defs_threshold = defs_threshold)
+    tab = disassembler.tab
+
+    out.line(disassembler.tab + 'DEVICE ZXSPECTRUM%d, #%04X' % (snapshot.type, min(snapshot.sp + 3, 0xFFFF)))
+
+    if entry_points:
+        out.line()
+        for ep in entry_points:
+            label = 'entry_point_%04X' % ep
+            value = labels[ep][0] if labels[ep] else '#%04X' % ep
+            disassembler.print_label(label, value)
+
+    out.line()
+    if sections:
+        paged_bank = snapshot.get_banks().paged_bank
+        out.line(tab + 'SLOT 3'); out.line(tab + 'PAGE %d' % paged_bank)
+    out.line(tab + 'ORG #4000')
+
+    small_labels = labels.items(0, 0x100)
+    for addr, addr_labels in small_labels:
+        del labels[addr]
+
+    disassembler.write_regions(_get_regions(blocks), jobs)
+
+    for addr, addr_labels in small_labels:
+        labels[addr] = addr_labels
+
+    rom_labels = labels.items(0, 0x4000)
+    if rom_labels:
+        out.line()
+        for addr, addr_labels in rom_labels:
+            for label in addr_labels:
+                disassembler.print_label(label, '#%04X' % addr)
+
+    for bank, bank_analyzer, bank_labels, bank_blocks in sections:
+        bank_disassembler = zxutils.Disassembler(bank_analyzer.memory, bank_labels, print_code_addr = print_code_addr, print_data_addr = print_data_addr, cache = bank_analyzer.cache, output = out, defs_threshold = defs_threshold)
+
+        out.line(); out.line(tab + 'PAGE %d' % bank); out.line(tab + 'MODULE bank%d' % bank); out.line(tab + 'ORG #C000')
+        bank_disassembler.write_regions(_get_regions(bank_blocks, 0xC000), jobs)
+        out.line(); out.line(tab + 'ENDMODULE')
+
+    if sections:
+        out.line(); out.line(tab + 'PAGE %d' % paged_bank)
+
+    out.line()
+    if entry_points:
+        out.line(disassembler.tab + 'SAVESNA "%s", entry_point_%04X' % (os.path.basename(snapshot.filename), entry_points[0]))
+    out.line(disassembler.tab + 'LABELSLIST "user.l"')
+
+    out.flush()
+
+
+def _expand_filenames(names):
+    filenames = []
+    for name in names:
+        if name.startswith('@'):
+            with open(name[1:]) as f:
+                filenames.extend(_expand_filenames([line.strip() for line in f if line.strip()]))
+        elif any(c in name for c in '*?['):
+            filenames.extend(sorted(glob.glob(name)))
+        else:
+            filenames.append(name)
+
+    return filenames
+
+
+def _process(filename, args):
+    """Disassembles snapshot in batch mode, returns (filename, elapsed time, number of warnings, error or None)."""
+
+    base = _get_output_base(filename, args)
+
+    zxutils.diagnostics.diagnostics.clear()
+    start = time.time()
+    error = None
+
+    try:
+        with open(base + '.asm', 'w') as f:
+            disassemble(filename, args, base + '.map', base + '.l', f)
+    except SystemExit as e:
+        error = str(e.code)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+
+    if error is not None:
+        for ext in '.asm', '.map', '.l':
+            if os.path.isfile(base + ext):
+                os.remove(base + ext)
+
+    return filename, time.time() - start, sum(zxutils.diagnostics.diagnostics.counts.values()), error
+
+
+def _get_output_base(filename, args):
+    # Output filename without extension - snapshot name in outdir (or next to the snapshot).
+    out_dir = args.d or os.path.dirname(filename)
+    return os.path.join(out_dir, os.path.splitext(os.path.basename(filename))[0])
+
+
+def batch(filenames, args):
+    """Disassembles snapshots in worker processes (each one loads decode tables once), returns number of failed ones."""
+
+    jobs = _try_int(args.j, (1, 1025)) if args.j else None
+    if args.d and not os.path.isdir(args.d):
+        os.makedirs(args.d)
+
+    start = time.time()
+    failed = 0
+
+    # Snapshots with the same name from different directories would overwrite each other's output in outdir.
+    owners = {}
+    unique = []
+    for filename in filenames:
+        base = os.path.normcase(os.path.abspath(_get_output_base(filename, args)))
+        if base in owners:
+            sys.stderr.write('%s: FAILED - output files "%s.*" are written for "%s" already.\n' % (filename, base, owners[base]))
+            failed += 1
+        else:
+            owners[base] = filename
+            unique.append(filename)
+
+    count = len(filenames)
+    filenames = unique
+
+    if jobs == 1 or len(filenames) == 1:
+        results = (_process(filename, args) for filename in filenames)
+        executor = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(jobs)
+        results = executor.map(_process, filenames, [args] * len(filenames))
 
-if entry_points:
-    print()
-    for ep in entry_points:
-        label = 'entry_point_%04X' % ep
-        value = labels[ep][0] if labels[ep] else '#%04X' % ep
-        disassembler.print_label(label, value)
+    for filename, elapsed, warnings, error in results:
+        if error is None:
+            sys.stderr.write('%s: %.2fs, %d warning(s).\n' % (filename, elapsed, warnings))
+        else:
+            sys.stderr.write('%s: FAILED after %.2fs - %s\n' % (filename, elapsed, error))
+            failed += 1
 
-print('\n' + disassembler.tab + 'ORG #4000')
+    if executor:
+        executor.shutdown()
 
-small_labels = labels[:0x100]
-labels[:0x100] = [[] for i in range(0x100)]
+    sys.stderr.write('%d snapshot(s) processed, %d failed in %.2fs.\n' % (count, failed, time.time() - start))
+    return failed
 
-addr = 0x4000
-for org, end in blocks:
-    if addr < org:
-        print(); disassembler.dump(addr, org)
-    print(); disassembler.disasm(org, end)
-    addr = end
-if addr < 0x10000:
-    print(); disassembler.dump(addr, 0x10000)
 
-labels[:0x100] = small_labels
+def main():
+    args = parser.parse_args()
 
-if any(labels[0:0x4000]):
-    print()
-    for addr in range(0x4000):
-        for label in labels[addr]:
-            disassembler.print_label(label, '#%04X' % addr) 
+    if args.d is not None:
+        if args.om or args.ol:
+            sys.exit('Options -om and -ol are not supported in batch mode.')
+        sys.exit(1 if batch(_expand_filenames(args.filename), args) else 0)
 
-print()
-if entry_points:
-    print(disassembler.tab + 'SAVESNA "%s", entry_point_%04X' % (os.path.basename(args.filename), entry_points[0]))
-print(disassembler.tab + 'LABELSLIST "user.l"')
+    if len(args.filename) > 1:
+        sys.exit('Multiple snapshots are supported in batch mode only (see -d).')
 
+    zxutils.diagnostics.report_at_exit()
+    disassemble(args.filename[0], args, args.om, args.ol, jobs = _try_int(args.j, (1, 1025)) if args.j else None)
 
-# Saving.
-if args.om:
-    map = [flag == True for flag in analyzer.map]
-    zxutils.map.save(args.om, map)
 
-if args.ol:
-    zxutils.labels.save(args.ol, labels)
+if __name__ == '__main__':
+    main()
@@ -1,106 +1,35 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-from __future__ import print_function
 import sys
-import os
 import struct
 import argparse
+import zxutils
+from zxutils.sna import prop_names, prop_sizes
 
 
-file_types = {49179: 48, 131103: 128, 147487: 128}
-prop_names = ('I', "HL'", "DE'", "BC'", "AF'", 'HL', 'DE', 'BC', 'IY', 'IX', 'INT_FLAGS', 'R', 'AF', 'SP', 'INT_MODE', 'BORDER', 'PC', '7FFD', 'TRDOS_ROM')
-prop_sizes = ( 1,   2,     2,     2,     2,     2,    2,    2,    2,    2,    1,           1,   2,    2,    1,          1,        2,    1,      1         )
+def warning(msg):
+    sys.stderr.write('Warning: ' + msg + '\n')
 
 
-def error(msg):
-    sys.exit('Error: ' + msg)
+def load_file_props(snapshot):
+    props = snapshot.get_props()
 
-def warning(msg):
-    sys.stderr.write('Warning: ' + msg + '\n')
+    if props['PC'] is None:
+        warning('Format is 48k and SP is out of RAM, setting PC = 0.')
+        props['PC'] = 0
 
+    return props
 
-def get_file_type(filename):
-    if not os.path.isfile(filename):
-        error('File "%s" not found.' % filename)
-
-    size = os.path.getsize(filename)
-    if size not in file_types:
-        error('File "%s" is not a valid SNA file.' % filename)
-
-    return file_types[size]
-
-
-def load_file_props(filename):
-    type = get_file_type(filename)
-
-    with open(filename, 'rb') as f:
-        props = {}
-
-        props['I'],\
-        props["HL'"],\
-        props["DE'"],\
-        props["BC'"],\
-        props["AF'"],\
-        props['HL'],\
-        props['DE'],\
-        props['BC'],\
-        props['IY'],\
-        props['IX'],\
-        props['INT_FLAGS'],\
-        props['R'],\
-        props['AF'],\
-        props['SP'],\
-        props['INT_MODE'],\
-        props['BORDER'],\
-        = struct.unpack('<BHHHHHHHHHBBHHBB', f.read(27))
-
-        if type == 48:
-            if 0x4000 <= props['SP'] <= 0xFFFE:
-                f.seek(27 + props['SP'] - 0x4000)
-                props['PC'], = struct.unpack('<H', f.read(2))
-            else:
-                warning('Format is 48k and SP is out of RAM, setting PC = 0.')
-                props['PC'] = 0
 
-            props['SP'] += 2
-            props['SP'] %= 0x10000
+def save_file_props(snapshot, props):
+    values = [props[name] for name in prop_names[:len(prop_names) - 3]] # header ones (I..BORDER)
+    if snapshot.type == 48:
+        values[prop_names.index('SP')] = (props['SP'] - 2) % 0x10000
 
-            props['7FFD'] = props['TRDOS_ROM'] = None
-        else:
-            f.seek(49179)
+    with open(snapshot.filename, 'r+b') as f:
+        f.write(zxutils.sna.header.pack(*values))
 
-            props['PC'],\
-            props['7FFD'],\
-            props['TRDOS_ROM'],\
-            = struct.unpack('<HBB', f.read(4))
-
-        return props
-
-
-def save_file_props(filename, props):
-    type = get_file_type(filename)
-
-    with open(filename, 'r+b') as f:
-        f.write(struct.pack('<BHHHHHHHHHBBHHBB',\
-        props['I'],\
-        props["HL'"],\
-        props["DE'"],\
-        props["BC'"],\
-        props["AF'"],\
-        props['HL'],\
-        props['DE'],\
-        props['BC'],\
-        props['IY'],\
-        props['IX'],\
-        props['INT_FLAGS'],\
-        props['R'],\
-        props['AF'],\
-        props['SP'] if type == 128 else (props['SP'] - 2) % 0x10000,\
-        props['INT_MODE'],\
-        props['BORDER'],\
-        ))
-
-        if type == 48:
+        if snapshot.type == 48:
             if props['SP'] - 2 >= 0x4000:
                 f.seek(27 + props['SP'] - 2 - 0x4000)
                 f.write(struct.pack('<H', props['PC']))
@@ -112,12 +41,7 @@ def save_file_props(filename, props):
                     warning('Ignoring %s in 48k format.' % name)
         else:
             f.seek(49179)
-
-            f.write(struct.pack('<HBB',\
-            props['PC'],\
-            props['7FFD'],\
-            props['TRDOS_ROM'],\
-            ))
+            f.write(zxutils.sna.trailer.pack(props['PC'], props['7FFD'], props['TRDOS_ROM']))
 
 
 def patch_prop(props, name, value):
@@ -185,7 +109,8 @@ if args.rw:
     args.r = args.w = True
 
 
-props = load_file_props(args.filename)
+snapshot = zxutils.sna.Snapshot(args.filename)
+props = load_file_props(snapshot)
 
 if args.w:
     input_props(props)
@@ -197,7 +122,7 @@ for name in prop_names:
         args.w = True
 
 if args.w:
-    save_file_props(args.filename, props)
+    save_file_props(snapshot, props)
 else:
     args.r = True
 
@@ -0,0 +1,35 @@
+import unittest
+
+from zxutils import CodeAnalyzer
+
+
+def _analyze(code, org = 0x8000):
+    ram = bytearray(0xC000)
+    ram[org - 0x4000:org - 0x4000 + len(code)] = code
+
+    analyzer = CodeAnalyzer(bytes(ram))
+    analyzer.add_entry_point(org)
+    return analyzer.get_cfg()
+
+
+class ControlFlowGraphTest(unittest.TestCase):
+
+    def test_conditional_return_ends_block(self):
+        cfg = _analyze(b'\x00\xC8\x00\xC9') # NOP; RET Z; NOP; RET
+
+        self.assertEqual([cfg.get_block(i) for i in range(len(cfg))], [(0x8000, 0x8002), (0x8002, 0x8004)])
+        self.assertEqual(cfg.get_successors(0), [1])
+        self.assertEqual(cfg.get_successors(1), [])
+        self.assertEqual(cfg.get_predecessors(1), [0])
+
+
+    def test_jump_to_next_instruction_is_single_edge(self):
+        cfg = _analyze(b'\x28\x00\x00\xC9') # JR Z,$+2; NOP; RET
+
+        self.assertEqual([cfg.get_block(i) for i in range(len(cfg))], [(0x8000, 0x8002), (0x8002, 0x8004)])
+        self.assertEqual(cfg.get_successors(0), [1])
+        self.assertEqual(cfg.get_predecessors(1), [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
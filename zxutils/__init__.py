@@ -1,6 +1,9 @@
 from . import sna
 from . import map
 from . import labels
+from . import diagnostics
 
-from .code_analysis import CodeAnalyzer
-from .disasm import Disassembler
+from .code_analysis import CodeAnalyzer, ControlFlowGraph
+from .disasm import Disassembler, InstructionCache, Record
+from .output import Output
+from .tables import Instruction, Operand
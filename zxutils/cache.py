@@ -0,0 +1,94 @@
+import os
+import time
+
+
+def get_dir():
+    """Returns directory for cached data: $ZXUTILS_CACHE_DIR, $XDG_CACHE_HOME/zxutils or ~/.cache/zxutils."""
+
+    path = os.environ.get('ZXUTILS_CACHE_DIR')
+    if not path:
+        path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'zxutils')
+    return path
+
+
+def get_path(name):
+    return os.path.join(get_dir(), name)
+
+
+def read(name):
+    """Returns content of cached file or None if it's missing or unreadable."""
+
+    try:
+        with open(get_path(name), 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def write(name, data):
+    """Atomically writes cached file, returns False if cache directory is not writable."""
+
+    path = get_path(name)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+
+    try:
+        if not os.path.isdir(get_dir()):
+            os.makedirs(get_dir())
+
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        return True
+    except (IOError, OSError):
+        try:
+            os.remove(temp_path)
+        except (IOError, OSError):
+            pass
+        return False
+
+
+def touch(name):
+    try:
+        os.utime(get_path(name), None)
+    except (IOError, OSError):
+        pass
+
+
+def remove(name):
+    try:
+        os.remove(get_path(name))
+    except (IOError, OSError):
+        pass
+
+
+def list_names(prefix):
+    try:
+        return [name for name in os.listdir(get_dir()) if name.startswith(prefix) and not name.endswith('.tmp')]
+    except (IOError, OSError):
+        return []
+
+
+def evict(prefix, max_size, max_age):
+    """Removes cached files with given prefix older than max_age seconds,
+    then the least recently used ones until their total size fits into max_size bytes."""
+
+    files = []
+    for name in list_names(prefix):
+        try:
+            st = os.stat(get_path(name))
+            files.append((st.st_mtime, st.st_size, name))
+        except (IOError, OSError):
+            pass
+
+    files.sort(reverse = True) # most recently used first
+    now = time.time()
+    total = 0
+
+    for mtime, size, name in files:
+        if total + size > max_size or now - mtime > max_age:
+            try:
+                os.remove(get_path(name))
+            except (IOError, OSError):
+                pass
+        else:
+            total += size
@@ -1,128 +1,130 @@
-import sys
+import zlib
+import marshal
+import hashlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
 
-from .opcodes import opcodes
 from . import memory
-from .disasm import decode
-
-
-opcodes[0x10]['flow'] = (True , 'relative') # DJNZ nn
-
-opcodes[0x18]['flow'] = (False, 'relative') # JR nn
-opcodes[0x38]['flow'] = (True , 'relative') # JR C,nn
-opcodes[0x30]['flow'] = (True , 'relative') # JR NC,nn
-opcodes[0x28]['flow'] = (True , 'relative') # JR Z,nn
-opcodes[0x20]['flow'] = (True , 'relative') # JR NZ,nn
-
-opcodes[0xC3]['flow'] = (False, 'absolute') # JP nn
-opcodes[0xDA]['flow'] = (True , 'absolute') # JP C,nn
-opcodes[0xD2]['flow'] = (True , 'absolute') # JP NC,nn
-opcodes[0xCA]['flow'] = (True , 'absolute') # JP Z,nn
-opcodes[0xC2]['flow'] = (True , 'absolute') # JP NZ,nn
-opcodes[0xF2]['flow'] = (True , 'absolute') # JP P,nn
-opcodes[0xFA]['flow'] = (True , 'absolute') # JP M,nn
-opcodes[0xE2]['flow'] = (True , 'absolute') # JP PO,nn
-opcodes[0xEA]['flow'] = (True , 'absolute') # JP PE,nn
-opcodes[0xE9]['flow'] = (False, 'indirect') # JP (HL)
-
-opcodes[0xCD]['flow'] = (True , 'absolute') # CALL nn
-opcodes[0xDC]['flow'] = (True , 'absolute') # CALL C,nn
-opcodes[0xD4]['flow'] = (True , 'absolute') # CALL NC,nn
-opcodes[0xCC]['flow'] = (True , 'absolute') # CALL Z,nn
-opcodes[0xC4]['flow'] = (True , 'absolute') # CALL NZ,nn
-opcodes[0xF4]['flow'] = (True , 'absolute') # CALL P,nn
-opcodes[0xFC]['flow'] = (True , 'absolute') # CALL M,nn
-opcodes[0xE4]['flow'] = (True , 'absolute') # CALL PO,nn
-opcodes[0xEC]['flow'] = (True , 'absolute') # CALL PE,nn
-
-opcodes[0xC9]['flow'] = (False, False) # RET
-opcodes[0xD8]['flow'] = (True , False) # RET C
-opcodes[0xD0]['flow'] = (True , False) # RET NC
-opcodes[0xC8]['flow'] = (True , False) # RET Z
-opcodes[0xC0]['flow'] = (True , False) # RET NZ
-opcodes[0xF0]['flow'] = (True , False) # RET P
-opcodes[0xF8]['flow'] = (True , False) # RET M
-opcodes[0xE0]['flow'] = (True , False) # RET PO
-opcodes[0xE8]['flow'] = (True , False) # RET PE
-
-opcodes[0xC7]['flow'] = (True , 0x00) # RST 00h
-opcodes[0xCF]['flow'] = (True , 0x08) # RST 08h
-opcodes[0xD7]['flow'] = (True , 0x10) # RST 10h
-opcodes[0xDF]['flow'] = (True , 0x18) # RST 18h
-opcodes[0xE7]['flow'] = (True , 0x20) # RST 20h
-opcodes[0xEF]['flow'] = (True , 0x28) # RST 28h
-opcodes[0xF7]['flow'] = (True , 0x30) # RST 30h
-opcodes[0xFF]['flow'] = (True , 0x38) # RST 38h
-
-opcodes[0xED][0x4D]['flow'] = (False, False) # RETI
-opcodes[0xED][0x45]['flow'] = (False, False) # RETN
-opcodes[0xED][0x55]['flow'] = (False, False) # RETN
-opcodes[0xED][0x5D]['flow'] = (False, False) # RETN
-opcodes[0xED][0x65]['flow'] = (False, False) # RETN
-opcodes[0xED][0x6D]['flow'] = (False, False) # RETN
-opcodes[0xED][0x75]['flow'] = (False, False) # RETN
-opcodes[0xED][0x7D]['flow'] = (False, False) # RETN
-
-opcodes[0xDD][0xE9]['flow'] = (False, 'indirect') # JP (IX)
-opcodes[0xFD][0xE9]['flow'] = (False, 'indirect') # JP (IY)
+from . import cache
+from . import tables
+from .diagnostics import warning
+from .disasm import InstructionCache
+from .map import Bitmap, as_bitmap
+
+
+# States of CodeAnalyzer.map bytes.
+UNKNOWN = 0
+OPCODE  = 1 # first byte of instruction
+OPERAND = 2 # other bytes of instruction
+DATA    = 3 # not set by tracing, could be set by callers to keep tracer away
+
+_marks = [bytes([OPCODE] + [OPERAND] * (size - 1)) for size in range(5)] # indexed by instruction size
+_unknown = [bytes(size) for size in range(5)]
+_exec_flags = bytes([state == OPCODE for state in range(256)])
+
+
+# Analysis cache (see CodeAnalyzer.load_cache) limits.
+CACHE_MAX_SIZE = 256 << 20
+CACHE_MAX_AGE  = 30 * 24 * 3600
+
+_cache_version = 3
+
+
+def _is_exec_map(addrs):
+    if isinstance(addrs, Bitmap):
+        return True
+    if isinstance(addrs, (bytes, bytearray)):
+        return len(addrs) == 0x10000
+    return isinstance(addrs, list) and len(addrs) == 0x10000 and type(addrs[0]) is bool
 
 
 class CodeAnalyzer:
 
-    def __init__(self, ram):
-        self.ram = ram
+    def __init__(self, mem, cache = None):
+        self.cache = cache if cache is not None else InstructionCache(mem)
+        self.memory = self.cache.memory
 
-        self.map = [None] * 0x10000
+        self.map = bytearray(0x10000)
         self._blocks = {}
         self._jumps = {}
 
 
     def add_entry_point(self, addr):
+        self.add_entry_points([addr])
+
+
+    def add_entry_points(self, addrs):
+        """Traces code from all addrs and everything reachable from them.
+
+        addrs is either an iterable of addresses or an execution map (Bitmap from map.load() or 64K flags).
+        Addresses of execution map are traced in ascending order and the ones already traced are skipped,
+        so most of them are absorbed by traces started from lower addresses.
+        """
+
+        if _is_exec_map(addrs):
+            for addr in addrs if isinstance(addrs, Bitmap) else [addr for addr, flag in enumerate(addrs) if flag]:
+                if self.map[addr] == UNKNOWN:
+                    self._trace_all(addr)
+        else:
+            for addr in addrs:
+                self._trace_all(addr)
+
+
+    def _trace_all(self, addr):
+        # Explicit worklist instead of recursion: jump targets found by a trace are traced next
+        # (depth first, in the same order recursive tracing used), so long call chains can't exhaust the stack.
+        worklist = deque([addr])
+        while worklist:
+            new_entry_points = self._trace(worklist.popleft())
+            worklist.extendleft(reversed(new_entry_points))
+
+
+    def _trace(self, addr):
         addr = memory.wrap(addr)
         if addr < 0x4000:
-            return
+            return []
 
         connect_to_next_block = False
         new_entry_points = set()
 
         org = addr
+        states = self.map
+        get = self.cache.get
 
         while True:
             if addr == 0x10000:
-                sys.stderr.write('Warning: memory end reached.\n')
-            elif self.map[addr]:
+                warning('memory-end', 'memory end reached.')
+            elif states[addr] == OPCODE:
                 connect_to_next_block = True
             else:
-                op = decode(self.ram, addr)
-                if op:
-                    next_addr = addr + op['size']
+                entry = get(addr)
+                if entry:
+                    op = entry.op
+                    next_addr = addr + op.size
 
                     if next_addr > 0x10000:
-                        sys.stderr.write('Warning: instruction at #%04X is out of memory.\n' % addr)
-                    elif any([flag is not None for flag in self.map[addr:next_addr]]):
-                        sys.stderr.write('Warning: instruction at #%04X overlaps another one.\n' % addr)
+                        warning('out-of-memory', 'instruction at #%04X is out of memory.', addr)
+                    elif not states.startswith(_unknown[op.size], addr):
+                        warning('overlap', 'instruction at #%04X overlaps another one.', addr)
                     else:
-                        self.map[addr:next_addr] = [True] + [False] * (op['size'] - 1)
+                        states[addr:next_addr] = _marks[op.size]
 
-                        cont, jump = op['flow'] if 'flow' in op else (True, False)
+                        jump_addr = entry.jump
 
-                        if jump:
-                            if jump is int:
-                                jump_addr = jump
-                            elif jump == 'absolute':
-                                jump_addr = memory.get_word(self.ram, next_addr - 2)
-                            elif jump == 'relative':
-                                jump_addr = memory.wrap(next_addr + memory.get_sbyte(self.ram, next_addr - 1))
-                            else:
-                                sys.stderr.write('Warning: indirect jump at #%04X - cannot follow.\n' % addr)
-                                jump_addr = None
+                        if jump_addr is not False:
+                            if jump_addr is None:
+                                warning('indirect-jump', 'indirect jump at #%04X - cannot follow.', addr)
 
                             self._jumps[addr] = jump_addr
-                            if jump_addr is not None:
+                            # RST targets are in ROM which isn't traced - not queuing them keeps the trace order
+                            # (and so the block merging) the same as when RST wasn't followed.
+                            if jump_addr is not None and type(op.flow[1]) is not int:
                                 new_entry_points.add(jump_addr)
 
                         addr = next_addr
 
-                        if cont:
+                        if op.flow[0]:
                             continue
             break
 
@@ -133,8 +135,97 @@ class CodeAnalyzer:
                 end = self._blocks.pop(end)[1]
             self._blocks[org] = (org, end)
 
-        for ep in new_entry_points:
-            self.add_entry_point(ep)
+        return list(new_entry_points)
+
+
+    def load_cache(self, entry_points, map = None):
+        """Restores state saved by save_cache() for the same RAM which is the longest prefix of tracing entry_points
+        one by one, then map - add_entry_points(entry_points) followed by add_entry_points(map).
+
+        Returns (number of leading entry_points restored, True if map is restored too) - the rest has to be traced
+        afterwards in the same order, so the result matches a fresh trace (warnings issued while tracing
+        the cached code are not repeated). Returns (0, False) if nothing is restored.
+        """
+
+        entry_points = tuple(entry_points)
+        map_digest = _get_map_digest(map)
+
+        best_name = best = None
+        for name in cache.list_names(self._get_cache_prefix()):
+            state = _read_state(name)
+            if state is None:
+                continue
+
+            cached_entry_points, cached_map_digest = state[0], state[1]
+            if cached_map_digest is None:
+                if entry_points[:len(cached_entry_points)] != cached_entry_points:
+                    continue
+            elif cached_entry_points != entry_points or cached_map_digest != map_digest:
+                continue
+
+            if best is None or (len(cached_entry_points), cached_map_digest is not None) > (len(best[0]), best[1] is not None):
+                best_name, best = name, state
+
+        if best is None:
+            return 0, False
+
+        self.map[:] = best[2]
+        self._blocks = best[3]
+        self._jumps = best[4]
+
+        cache.touch(best_name)
+        return len(best[0]), best[1] is not None
+
+
+    def save_cache(self, entry_points, map = None):
+        """Saves state traced from entry_points, then map (see load_cache()),
+        evicting old entries to fit CACHE_MAX_SIZE and CACHE_MAX_AGE."""
+
+        key = (tuple(entry_points), _get_map_digest(map))
+
+        name = self._get_cache_prefix() + hashlib.sha1(marshal.dumps(key)).hexdigest()[:16]
+        data = zlib.compress(marshal.dumps(key + (bytes(self.map), self._blocks, self._jumps)))
+
+        if cache.write(name, data):
+            cache.evict('analysis-', CACHE_MAX_SIZE, CACHE_MAX_AGE)
+
+
+    def _get_cache_prefix(self):
+        # Analysis depends on the decode tables as well as on RAM.
+        digest = hashlib.sha1(tables.get_signature().encode('ascii'))
+        digest.update(self.memory.ram)
+        return 'analysis-%d-%s-' % (_cache_version, digest.hexdigest())
+
+
+    def fork(self, mem, end = 0xC000):
+        """Returns CodeAnalyzer of mem which matches the analyzed memory below end (e.g. another bank paged at #C000).
+
+        It starts with code traced so far below end (blocks are cut at end), so tracing it only follows
+        the code which differs and connects to the shared one instead of tracing it again.
+        """
+
+        analyzer = CodeAnalyzer(mem)
+        analyzer.map[0:end] = self.map[0:end]
+
+        for org, (block_org, block_end) in self._blocks.items():
+            if org < end:
+                analyzer._blocks[org] = (block_org, min(block_end, end))
+
+        for addr, target in self._jumps.items():
+            if addr < end:
+                analyzer._jumps[addr] = target
+
+        return analyzer
+
+
+    def get_exec_map(self):
+        """Returns bytes with 1 at every opcode start and 0 elsewhere - suitable for map.save()."""
+
+        return self.map.translate(_exec_flags)
+
+
+    def get_cfg(self):
+        return ControlFlowGraph(self)
 
 
     def get_code_blocks(self):
@@ -143,3 +234,134 @@ class CodeAnalyzer:
 
     def get_jumps(self):
         return self._jumps
+
+
+def _get_map_digest(map):
+    return hashlib.sha1(as_bitmap(map).data).hexdigest() if map is not None else None
+
+
+def _read_state(name):
+    data = cache.read(name)
+    if data is None:
+        return None
+
+    try:
+        entry_points, map_digest, map, blocks, jumps = marshal.loads(zlib.decompress(data))
+        return tuple(entry_points), map_digest, map, blocks, jumps
+    except (zlib.error, EOFError, ValueError, TypeError):
+        return None
+
+
+
+class ControlFlowGraph:
+    """Basic blocks of traced code with successor/predecessor indexes.
+
+    Code blocks of CodeAnalyzer are split at every jump target and after every instruction changing the flow
+    (jumps, calls, RSTs and returns, conditional ones included). Blocks are indexed in address order,
+    edges are stored as compact adjacency arrays. Build it with CodeAnalyzer.get_cfg() once tracing is done.
+    """
+
+    def __init__(self, analyzer):
+        blocks = analyzer.get_code_blocks()
+        jumps = analyzer.get_jumps()
+
+        splits = set(org for org, end in blocks)
+        for target in jumps.values():
+            if target is not None and analyzer.map[target] == OPCODE:
+                splits.add(target)
+
+        exits = {} # address after flow changing instruction -> (its address, continues to the next instruction)
+        for org, end in blocks:
+            addr = org
+            while addr < end:
+                op = analyzer.cache.get(addr).op
+                next_addr = addr + op.size
+
+                if op.flow != (True, False):
+                    splits.add(next_addr)
+                    exits[next_addr] = (addr, op.flow[0])
+
+                addr = next_addr
+
+        splits = sorted(splits)
+
+        self._starts = array('l')
+        self._ends = array('l')
+
+        for org, end in blocks:
+            points = splits[bisect_left(splits, org):bisect_left(splits, end)] + [end]
+            self._starts.extend(points[:-1])
+            self._ends.extend(points[1:])
+
+        index = dict((start, i) for i, start in enumerate(self._starts))
+
+        successors = []
+        for end in self._ends:
+            succs = []
+
+            src, cont = exits.get(end, (None, True))
+            if cont and end in index:
+                succs.append(index[end])
+            if src is not None and jumps.get(src) in index:
+                succ = index[jumps[src]]
+                if succ not in succs: # conditional jump to the next instruction is a single edge
+                    succs.append(succ)
+
+            successors.append(succs)
+
+        predecessors = [[] for i in range(len(successors))]
+        for i, succs in enumerate(successors):
+            for succ in succs:
+                predecessors[succ].append(i)
+
+        self._successors = _Adjacency(successors)
+        self._predecessors = _Adjacency(predecessors)
+
+        calls = sorted((target, src) for src, target in jumps.items() if target is not None)
+        self._call_targets = array('l', [target for target, src in calls])
+        self._call_sources = array('l', [src for target, src in calls])
+
+
+    def __len__(self):
+        return len(self._starts)
+
+
+    def get_block(self, index):
+        return self._starts[index], self._ends[index]
+
+
+    def find_block(self, addr):
+        """Returns index of the block containing addr or None."""
+
+        index = bisect_right(self._starts, addr) - 1
+        return index if index >= 0 and addr < self._ends[index] else None
+
+
+    def get_successors(self, index):
+        return self._successors.get(index)
+
+
+    def get_predecessors(self, index):
+        return self._predecessors.get(index)
+
+
+    def get_callers(self, addr):
+        """Returns addresses of all jumps, calls and RSTs targeting addr (in or outside the code)."""
+
+        return self._call_sources[bisect_left(self._call_targets, addr):bisect_right(self._call_targets, addr)].tolist()
+
+
+class _Adjacency:
+    # Lists of block indexes packed into one array, list i is items[offsets[i]:offsets[i + 1]].
+
+    def __init__(self, lists):
+        self.offsets = array('l', [0])
+        self.items = array('l')
+
+        for items in lists:
+            self.items.extend(items)
+            self.offsets.append(len(self.items))
+
+
+    def get(self, index):
+        return self.items[self.offsets[index]:self.offsets[index + 1]].tolist()
@@ -0,0 +1,73 @@
+"""Warnings issued by zxutils.
+
+Warnings are counted per category and only the first few of each category are kept (formatted lazily),
+so issuing them in hot loops costs no I/O. Library callers read them via diagnostics.counts and
+diagnostics.get_samples(), command line tools print them with report() or report_at_exit().
+"""
+
+import sys
+import atexit
+
+
+class Diagnostics:
+
+    def __init__(self, max_samples = 10):
+        self.max_samples = max_samples
+
+        self.counts = {} # category -> number of warnings
+        self._samples = {} # category -> [(msg, args)]
+
+
+    def warning(self, category, msg, *args):
+        count = self.counts.get(category, 0) + 1
+        self.counts[category] = count
+
+        if count <= self.max_samples:
+            self._samples.setdefault(category, []).append((msg, args))
+
+
+    def get_samples(self, category):
+        return [msg % args if args else msg for msg, args in self._samples.get(category, [])]
+
+
+    def merge(self, other):
+        """Adds warnings collected by other Diagnostics (e.g. returned from a worker process)."""
+
+        for category, count in other.counts.items():
+            self.counts[category] = self.counts.get(category, 0) + count
+
+            samples = self._samples.setdefault(category, [])
+            samples.extend(other._samples.get(category, [])[:self.max_samples - len(samples)])
+
+
+    def clear(self):
+        self.counts.clear()
+        self._samples.clear()
+
+
+    def report(self, file = None):
+        """Writes kept warnings of every category followed by the number of omitted ones."""
+
+        file = file or sys.stderr
+
+        lines = []
+        for category in self.counts:
+            for sample in self.get_samples(category):
+                lines.append('Warning: %s\n' % sample)
+
+            omitted = self.counts[category] - self.max_samples
+            if omitted > 0:
+                lines.append('Warning: %d more "%s" warning(s) omitted.\n' % (omitted, category))
+
+        file.write(''.join(lines))
+
+
+diagnostics = Diagnostics()
+
+
+def warning(category, msg, *args):
+    diagnostics.warning(category, msg, *args)
+
+
+def report_at_exit(file = None):
+    atexit.register(diagnostics.report, file)
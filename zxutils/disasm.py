@@ -1,131 +1,537 @@
-from __future__ import print_function
-import sys
+import re
+import io
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 
-from .opcodes import opcodes
 from . import memory
+from . import tables
+from . import diagnostics
+from .diagnostics import warning
+from .output import Output
+from .tables import SLOT_BYTE, SLOT_WORD
 
 
-def _decode(ram, addr, table):
-    op = table[memory.get_byte(ram, addr)]
-    return op if type(op) is not list else _decode(ram, addr + 1 + op[256], op)
+# Decode tables (see tables.py), loaded on first use by _load().
+_tables = _skips = _main = None
 
+def _load():
+    global _tables, _skips, _main
 
-def decode(ram, addr):
-    op = _decode(ram, addr, opcodes)
+    if _tables is None:
+        _tables, _skips = tables.load()
+        _main = _tables[0]
+
+
+_hex_bytes = ['#%02X' % i for i in range(0x100)]
+_hex_offsets = ['-#%02X' % (0x80 - i) for i in range(0x80)] + ['+#%02X' % i for i in range(0x80)] # indexed by offset + 128
+_hex_words = None # built on first use, see _get_hex_words()
+
+def _get_hex_words():
+    global _hex_words
+
+    if _hex_words is None:
+        _hex_words = ['#%04X' % i for i in range(0x10000)]
+
+    return _hex_words
+
+
+def _decode(data, addr):
+    # data is AddressSpace buffer - it's safe to read up to 4 bytes after #FFFF.
+    op = _main[data[addr]]
+    while type(op) is int:
+        addr += 1 + _skips[op]
+        op = _tables[op][data[addr]]
+
+    return op
+
+
+def _window(ram, addr):
+    # Bytes of instruction at addr of 48K RAM which doesn't fit into it - ROM reads as 0, addresses wrap around.
+    return bytearray(ram[a - 0x4000] if a >= 0x4000 else 0 for a in [a & 0xFFFF for a in range(addr, addr + 4)])
+
+
+def decode(mem, addr):
+    """Returns Instruction at addr of AddressSpace mem (or 48K RAM - read in place) or None if it's invalid."""
+
+    if _main is None:
+        _load()
+
+    if isinstance(mem, memory.AddressSpace):
+        data, pos = mem.buffer, addr
+    elif 0x4000 <= addr <= len(mem) + 0x3FFC:
+        data, pos = mem, addr - 0x4000
+    else:
+        data, pos = _window(mem, addr), 0
+
+    # Table walk of _decode() inlined - it's the whole cost of the call.
+    op = _main[data[pos]]
+    while type(op) is int:
+        pos += 1 + _skips[op]
+        op = _tables[op][data[pos]]
 
     if not op:
-        sys.stderr.write('Warning: invalid instruction at #%04X.\n' % addr)
+        warning('invalid-instruction', 'invalid instruction at #%04X.', addr)
 
     return op
 
 
+# Flow kinds returned by sweep().
+FLOW_NEXT        = 0 # continues to the next instruction
+FLOW_BRANCH      = 1 # conditional jump, call or RST - continues and may jump
+FLOW_JUMP        = 2 # unconditional jump
+FLOW_RETURN      = 3 # unconditional return
+FLOW_INDIRECT    = 4 # JP (HL), JP (IX), JP (IY)
+FLOW_COND_RETURN = 5 # conditional return - continues and may return
+
+
+def _get_flow_kind(op):
+    cont, jump = op.flow
+
+    if cont:
+        if jump is False:
+            return FLOW_NEXT
+        return FLOW_COND_RETURN if jump == 'return' else FLOW_BRANCH
+    elif jump == 'return':
+        return FLOW_RETURN
+    elif jump == 'indirect':
+        return FLOW_INDIRECT
+    else:
+        return FLOW_JUMP
+
+
+_sweep_tables = None
+
+def _get_sweep_tables(numpy):
+    global _sweep_tables
+
+    if _sweep_tables is None:
+        shape = (len(_tables), 256)
+        nexts, sizes, flows = numpy.zeros(shape, numpy.uint8), numpy.zeros(shape, numpy.uint8), numpy.zeros(shape, numpy.uint8)
+
+        for index, table in enumerate(_tables):
+            for code, op in enumerate(table):
+                if type(op) is int:
+                    nexts[index, code] = op
+                elif op:
+                    sizes[index, code] = op.size
+                    flows[index, code] = _get_flow_kind(op)
+
+        _sweep_tables = nexts, sizes, flows
+
+    return _sweep_tables
+
+
+def sweep(mem):
+    """Decodes instruction at every RAM address (#4000..#FFFF) of AddressSpace (or 48K RAM) mem at once.
+
+    Returns (sizes, prefixes, flows) - arrays of #C000 bytes:
+    sizes    - instruction size, 0 for invalid instruction
+    prefixes - index of the decode table the opcode came from (0 - unprefixed, 1 - CB, 2 - DD, 3 - DDCB, 4 - ED, 5 - FD, 6 - FDCB)
+    flows    - FLOW_* kind of the instruction
+
+    Uses NumPy gathers over the decode tables when NumPy is available (returning uint8 arrays),
+    otherwise falls back to decoding addresses one by one (returning bytearrays).
+    """
+
+    mem = memory.as_address_space(mem)
+    _load()
+
+    try:
+        import numpy
+    except ImportError:
+        return _sweep(mem)
+
+    nexts, sizes, flows = _get_sweep_tables(numpy)
+
+    n = 0xC000
+    data = numpy.frombuffer(mem.buffer, numpy.uint8)[0x4000:] # including bytes after #FFFF
+
+    index = nexts[0, data[0:n]]
+    code = data[0:n].copy()
+
+    prefixed = index != 0
+    code[prefixed] = data[1:n + 1][prefixed]
+
+    sub_index = nexts[index, code]
+    prefixed = sub_index != 0 # DDCB & FDCB - opcode follows the displacement byte
+    index[prefixed] = sub_index[prefixed]
+    code[prefixed] = data[3:n + 3][prefixed]
+
+    return sizes[index, code], index, flows[index, code]
+
+
+def _sweep(mem):
+    data = mem.buffer
+    sizes, prefixes, flows = bytearray(0xC000), bytearray(0xC000), bytearray(0xC000)
+
+    for offset in range(0xC000):
+        pos = 0x4000 + offset
+
+        index = 0
+        op = _main[data[pos]]
+        while type(op) is int:
+            index = op
+            pos += 1 + _skips[op]
+            op = _tables[op][data[pos]]
+
+        if op:
+            sizes[offset] = op.size
+            flows[offset] = _get_flow_kind(op)
+        prefixes[offset] = index
+
+    return sizes, prefixes, flows
+
+
+def _resolve_args(data, addr, op):
+    # data is AddressSpace buffer, arguments are read from it directly - this runs for most traced instructions.
+    values = []
+
+    for arg in op.args:
+        pos = addr + arg.pos
+
+        if arg.size == 2:
+            value = data[pos] | data[pos + 1] << 8
+        elif arg.relative:
+            value = memory.wrap(addr + op.size + (data[pos] ^ 0x80) - 0x80)
+        elif arg.signed:
+            value = (data[pos] ^ 0x80) - 0x80
+        else:
+            value = data[pos]
+
+        values.append(value)
+
+    return tuple(values)
+
+
+def _resolve_jump(op, args):
+    jump = op.flow[1]
+
+    if jump in ('absolute', 'relative'):
+        return args[-1]
+    elif jump == 'indirect':
+        return None
+    elif jump == 'return':
+        return False
+    else:
+        return jump # RST address or False
+
+
+Decoded = namedtuple('Decoded', 'op data args jump')
+Decoded.__doc__ = """Decoded instruction:
+op   - Instruction from the decode tables
+data - instruction bytes it was decoded from
+args - resolved argument values (relative ones are converted to absolute addresses)
+jump - jump target address, None for indirect jump, False for no jump (and for returns)
+"""
+
+_new_decoded = tuple.__new__ # Decoded(...) without the Python level __new__ call
+
+
+class InstructionCache:
+    """Decoded instructions keyed by address, shared by CodeAnalyzer and Disassembler.
+
+    CodeAnalyzer fills it with every instruction it traces (but not with code restored by load_cache()),
+    Disassembler created with the same cache (cache = analyzer.cache) reuses the entries instead of decoding again.
+    Entry is dropped once memory doesn't match its data any more.
+    """
+
+    def __init__(self, mem):
+        self.memory = memory.as_address_space(mem)
+        self._entries = {}
+
+
+    def get(self, addr):
+        data = self.memory.buffer
+
+        entry = self._entries.get(addr)
+        if entry is not None and data.startswith(entry.data, addr):
+            return entry
+
+        if _main is None:
+            _load()
+
+        # Table walk of _decode() inlined, CodeAnalyzer calls this for every traced instruction.
+        pos = addr
+        op = _main[data[pos]]
+        while type(op) is int:
+            pos += 1 + _skips[op]
+            op = _tables[op][data[pos]]
+
+        if not op:
+            warning('invalid-instruction', 'invalid instruction at #%04X.', addr)
+            return None
+
+        next_addr = addr + op.size
+        if next_addr > 0x10000:
+            return Decoded(op, None, None, None)
+
+        if op.args:
+            args = _resolve_args(data, addr, op)
+            jump = _resolve_jump(op, args) if op.flow[1] is not False else False
+        else:
+            args = ()
+            jump = op.flow[1]
+            if type(jump) is str: # 'indirect' or 'return'
+                jump = None if jump == 'indirect' else False
+
+        entry = _new_decoded(Decoded, (op, bytes(data[addr:next_addr]), args, jump))
+        self._entries[addr] = entry
+
+        return entry
+
+
+# Kinds of listing records.
+KIND_CODE  = 'code'  # instruction
+KIND_DATA  = 'data'  # DB row
+KIND_EQU   = 'equ'   # labels inside previous instruction - operands are ('$-n',)
+KIND_BREAK = 'break' # empty line separating code from data it falls into
+
+Record = namedtuple('Record', 'kind addr data mnemonic operands labels')
+Record.__doc__ = """Listing record:
+kind     - KIND_* constant
+addr     - address
+data     - bytes the record covers
+mnemonic - instruction mnemonic, 'DB', 'DEFS' (operands are size and value) or 'EQU'
+operands - tuple of formatted operands (with addresses replaced by labels)
+labels   - labels at addr
+"""
+
+_break = Record(KIND_BREAK, None, b'', '', (), ())
+
+_run_patterns = {} # DEFS threshold -> pattern matching runs of identical bytes
+
+def _get_run_pattern(threshold):
+    pattern = _run_patterns.get(threshold)
+    if pattern is None:
+        pattern = _run_patterns[threshold] = re.compile(b'(.)\\1{%d,}' % (threshold - 1), re.S)
+    return pattern
+
+
 class Disassembler:
+    """Renders assembler listing of AddressSpace mem.
+
+    iter_lines() and iter_dump() yield listing Records, disasm() and dump() write them as text into output
+    (Output sink, see output.py). labels is a Labels table (see labels.py) or None. With defs_threshold
+    runs of at least that many identical data bytes are dumped as DEFS. Output is buffered - call flush() when done
+    (the default one, writing to stdout, is flushed at the end of every call).
+    """
 
-    def __init__(self, ram, labels = None, tab_size = 20, print_code_addr = False, print_data_addr = False):
-        self.ram = ram
+    def __init__(self, mem, labels = None, tab_size = 20, print_code_addr = False, print_data_addr = False, cache = None, output = None, defs_threshold = None):
+        self.cache = cache if cache is not None else InstructionCache(mem)
+        self.memory = self.cache.memory
         self.labels = labels
+        self.output = output if output is not None else Output()
+        self._own_output = output is None
+        self._hex_words = _get_hex_words()
 
         self.tab = ' ' * tab_size
         self.print_code_addr = print_code_addr
         self.print_data_addr = print_data_addr
+        self.defs_threshold = defs_threshold
+
+
+    def flush(self):
+        self.output.flush()
 
 
     def print_label(self, label, value = None):
+        self.output.line(self._format_label(label, value))
+        self._flush_own()
+
+
+    def _format_label(self, label, value = None):
         if value is not None:
             label += ' ' * max(len(self.tab) - len(label), 1) + 'EQU ' + value
 
-        print(label)
+        return label
 
 
     def dump(self, org = None, end = None, size = None, align = 16):
+        self.write(self.iter_dump(org, end, size, align))
+
+
+    def disasm(self, org = None, end = None, size = None):
+        self.write(self.iter_lines(org, end, size))
+
+
+    def write_regions(self, regions, jobs = None):
+        """Writes regions - list of (org, end, is_code) - each one after an empty line, disassembling code ones
+        and dumping the others. With jobs > 1 regions are rendered by that many worker processes and merged in order.
+        """
+
+        if not jobs or jobs < 2 or len(regions) < 2:
+            for org, end, is_code in regions:
+                self.output.line()
+                self._write(self.iter_lines(org, end) if is_code else self.iter_dump(org, end))
+            self._flush_own()
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        state = (bytes(self.memory.buffer[0:0x10000]), self.labels, len(self.tab), self.print_code_addr, self.print_data_addr, self.defs_threshold)
+
+        with ProcessPoolExecutor(jobs, initializer = _init_worker, initargs = (state,)) as executor:
+            for text, worker_diagnostics in executor.map(_render_regions, _split_regions(regions, jobs * 4)):
+                self.output.write(text)
+                diagnostics.diagnostics.merge(worker_diagnostics)
+
+        self._flush_own()
+
+
+    def _flush_own(self):
+        # Default output isn't seen by the caller, so it's flushed once at the end of every public call writing into it.
+        if self._own_output:
+            self.output.flush()
+
+
+    def write(self, records):
+        """Writes records as assembler text."""
+
+        self._write(records)
+        self._flush_own()
+
+
+    def _write(self, records):
+        line = self.output.line
+        format_label = self._format_label
+
+        for record in records:
+            kind = record.kind
+
+            if kind == KIND_EQU:
+                for label in record.labels:
+                    line(format_label(label, record.operands[0]))
+                continue
+            elif kind == KIND_BREAK:
+                line()
+                continue
+
+            for label in record.labels:
+                line(label)
+
+            text = record.mnemonic + ' ' + ','.join(record.operands) if record.operands else record.mnemonic
+            print_addr = self.print_code_addr if kind == KIND_CODE else self.print_data_addr
+            line(self._get_line_prefix(record.addr if print_addr else None) + text)
+
+
+    def iter_dump(self, org = None, end = None, size = None, align = 16):
+        """Yields KIND_DATA records - DB rows of up to align bytes and DEFS runs (rows and runs are split at labels)."""
+
         org, end = _get_limits(org, end, size)
 
+        data = self.memory.buffer
+        hex_bytes = _hex_bytes
+        label_addrs = self.labels.addrs(org, end) if self.labels else ()
+        next_label = 0
+        runs = self._find_runs(org, end, label_addrs) if self.defs_threshold else ()
+        next_run = 0
+
         addr = org
-        n = 0
         while addr < end:
-            if self.labels and self.labels[addr]:
-                if n > 0:
-                    print()
-                    n = 0
-                for label in self.labels[addr]:
-                    self.print_label(label)
-
-            if n == 0:
-                print(self._get_line_prefix(addr if self.print_data_addr else None), end = '')
-                print('DB ', end = '')
-            else:
-                print(',', end = '')
-            print('#%02X' % memory.get_byte(self.ram, addr), end = '')
-
-            addr += 1
-            n += 1
-
-            if addr % align == 0:
-                print()
-                n = 0
-        if n > 0:
-            print()
+            labels = ()
+            if next_label < len(label_addrs) and label_addrs[next_label] == addr:
+                labels = self.labels[addr]
+                next_label += 1
 
+            if next_run < len(runs) and runs[next_run][0] == addr:
+                run_end = runs[next_run][1]
+                next_run += 1
+
+                yield Record(KIND_DATA, addr, bytes(data[addr:run_end]), 'DEFS', ('%d' % (run_end - addr), hex_bytes[data[addr]]), labels)
+                addr = run_end
+                continue
+
+            # Row ends at alignment boundary, at the end or before the next label or run.
+            row_end = min((addr // align + 1) * align, end)
+            if next_label < len(label_addrs):
+                row_end = min(row_end, label_addrs[next_label])
+            if next_run < len(runs):
+                row_end = min(row_end, runs[next_run][0])
+
+            row = bytes(data[addr:row_end])
+            yield Record(KIND_DATA, addr, row, 'DB', tuple([hex_bytes[byte] for byte in row]), labels)
+            addr = row_end
+
+
+    def _find_runs(self, org, end, label_addrs):
+        # Runs are found by a regular expression scan over the buffer, then split at labels.
+        threshold = self.defs_threshold
+        runs = []
+
+        for match in _get_run_pattern(threshold).finditer(self.memory.buffer, org, end):
+            start, stop = match.span()
+
+            for label_addr in label_addrs[bisect_right(label_addrs, start):bisect_left(label_addrs, stop)]:
+                if label_addr - start >= threshold:
+                    runs.append((start, label_addr))
+                start = label_addr
+
+            if stop - start >= threshold:
+                runs.append((start, stop))
+
+        return runs
+
+
+    def iter_lines(self, org = None, end = None, size = None):
+        """Yields KIND_CODE records (followed by KIND_EQU ones for labels inside instructions),
+        from the first invalid instruction - KIND_BREAK record and iter_dump() records up to the end.
+        """
 
-    def disasm(self, org = None, end = None, size = None):
         org, end = _get_limits(org, end, size)
+        labels = self.labels
 
         addr = org
         while addr < end:
-            op = decode(self.ram, addr)
+            entry = self.cache.get(addr)
+            op = entry.op if entry else None
 
-            if addr + op['size'] > 0x10000:
-                sys.stderr.write('Warning: instruction at [#%04X - #%04X] is falled out of memory.\n' % (addr, addr + op['size'] - 1))
+            if op and addr + op.size > 0x10000:
+                warning('out-of-memory', 'instruction at [#%04X - #%04X] is falled out of memory.', addr, addr + op.size - 1)
                 op = None
-        
-            if op:
-                next_addr = addr + op['size']
 
-                if self.labels:
-                    for label in self.labels[addr]:
-                        self.print_label(label)
+            if not op:
+                yield _break
+                for record in self.iter_dump(addr, end):
+                    yield record
+                return
+
+            next_addr = addr + op.size
+            yield Record(KIND_CODE, addr, entry.data, op.mnemonic, self._format_operands(op, entry.args), labels[addr] if labels else ())
 
-                asm = op['asm']
+            if labels:
+                for inner_addr in range(addr + 1, next_addr):
+                    if labels[inner_addr]:
+                        yield Record(KIND_EQU, inner_addr, b'', 'EQU', ('$-%d' % (next_addr - inner_addr),), labels[inner_addr])
 
-                if 'args' in op:
-                    for arg in op['args']:
-                        arg_pos = addr + arg['pos']
-                        arg_size = arg['size']
+            addr = next_addr
 
-                        relative = 'relative' in arg and arg['relative']
-                        signed = 'signed' in arg and arg['signed']
 
-                        if arg_size == 2:
-                            arg = memory.get_word(self.ram, arg_pos)
-                        elif relative:
-                            arg = memory.wrap(next_addr + memory.get_sbyte(self.ram, arg_pos))
-                            arg_size = 2
-                        elif signed:
-                            arg = memory.get_sbyte(self.ram, arg_pos)
-                        else:
-                            arg = memory.get_byte(self.ram, arg_pos)
+    def _format_operands(self, op, args):
+        labels = self.labels
+        hex_words = self._hex_words
 
-                        if arg_size == 2 and self.labels and self.labels[arg]:
-                            arg = self.labels[arg][0]
-                        elif signed:
-                            arg = ('+' if arg >= 0 else '-') + '#%02X' % abs(arg)
-                        else:
-                            arg = '#%%0%dX' % (2 * arg_size) % arg
+        operands = []
+        values = iter(args)
 
-                        asm = asm.replace('%', arg, 1)
+        for parts, slots in op.operands:
+            if not slots:
+                operands.append(parts[0])
+                continue
 
-                print(self._get_line_prefix(addr if self.print_code_addr else None), end = '')
-                print(asm)
+            strs = [parts[0]]
+            for slot, part in zip(slots, parts[1:]):
+                value = next(values)
+                if slot == SLOT_WORD:
+                    strs.append(labels[value][0] if labels and labels[value] else hex_words[value])
+                elif slot == SLOT_BYTE:
+                    strs.append(_hex_bytes[value])
+                else:
+                    strs.append(_hex_offsets[value + 128])
+                strs.append(part)
 
-                if self.labels:
-                    for inner_addr in range(addr + 1, next_addr):
-                        for label in self.labels[inner_addr]:
-                            self.print_label(label, '$-%d' % (next_addr - inner_addr))
+            operands.append(''.join(strs))
 
-                addr = next_addr
-            else:
-                print()
-                return self.dump(addr, end)
+        return tuple(operands)
 
 
     def _get_line_prefix(self, addr):
@@ -135,6 +541,44 @@ class Disassembler:
             return self.tab
 
 
+# Parallel rendering (see Disassembler.write_regions) - every worker process keeps its own Disassembler.
+_worker = None
+
+def _init_worker(state):
+    global _worker
+
+    data, labels, tab_size, print_code_addr, print_data_addr, defs_threshold = state
+    mem = memory.AddressSpace(data[0x4000:], data[0:0x4000])
+    _worker = Disassembler(mem, labels, tab_size, print_code_addr, print_data_addr, defs_threshold = defs_threshold)
+
+
+def _render_regions(regions):
+    # Returns listing text and warnings issued while rendering it.
+    diagnostics.diagnostics.clear()
+
+    _worker.output = Output(io.StringIO())
+    _worker.write_regions(regions)
+    _worker.flush()
+
+    return _worker.output.file.getvalue(), diagnostics.diagnostics
+
+
+def _split_regions(regions, count):
+    # Splits regions into up to count groups of consecutive ones with similar total size.
+    chunk_size = sum([end - org for org, end, is_code in regions]) // count + 1
+
+    groups = [[]]
+    size = 0
+    for region in regions:
+        if size >= chunk_size:
+            groups.append([])
+            size = 0
+        groups[-1].append(region)
+        size += region[1] - region[0]
+
+    return groups
+
+
 def _get_limits(org = None, end = None, size = None):
     if org is None:
         org = 0x4000
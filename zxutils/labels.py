@@ -1,45 +1,346 @@
 import sys
 import os
+import re
+import marshal
+import hashlib
+from bisect import bisect_left
+
+from . import cache
+from .diagnostics import warning
+
+
+class Labels:
+    """Sparse table of labels keyed by address.
+
+    labels[addr] is the list of labels at addr or an empty tuple if there are none, use add() to add a label.
+    Iteration, len() and addrs() cover labelled addresses only (in ascending order).
+    """
+
+    def __init__(self):
+        self._labels = {} # addr -> [label]
+        self._addrs = [] # sorted labelled addresses, None when it has to be rebuilt
+
+
+    def __getitem__(self, addr):
+        return self._labels.get(addr, ())
+
+
+    def __setitem__(self, addr, labels):
+        if labels:
+            if addr not in self._labels:
+                self._addrs = None
+            self._labels[addr] = list(labels)
+        elif addr in self._labels:
+            del self[addr]
+
+
+    def __delitem__(self, addr):
+        del self._labels[addr]
+        self._addrs = None
+
+
+    def __contains__(self, addr):
+        return addr in self._labels
+
+
+    def __len__(self):
+        return len(self._labels)
+
+
+    def __bool__(self):
+        return bool(self._labels)
+
+
+    def __iter__(self):
+        return iter(self._get_addrs())
+
+
+    def add(self, addr, label):
+        labels = self._labels.get(addr)
+        if labels is None:
+            self._labels[addr] = [label]
+            self._addrs = None
+        else:
+            labels.append(label)
+
+
+    def addrs(self, org = 0, end = 0x10000):
+        """Returns sorted list of labelled addresses in [org, end)."""
+
+        addrs = self._get_addrs()
+        return addrs[bisect_left(addrs, org):bisect_left(addrs, end)]
+
+
+    def items(self, org = 0, end = 0x10000):
+        """Returns sorted list of (addr, labels) for labelled addresses in [org, end)."""
+
+        return [(addr, self._labels[addr]) for addr in self.addrs(org, end)]
+
+
+    def _get_addrs(self):
+        if self._addrs is None:
+            self._addrs = sorted(self._labels)
+        return self._addrs
+
+
+class LabelIndex:
+    """Labels indexed by name: name -> addresses hash and a trie over dotted names for scope queries.
+
+    Macro labels (SjASMPlus ones containing '>') are collected in macros set while adding.
+    """
+
+    def __init__(self, labels = None):
+        self._addrs = {} # name -> [addr] (the same name could be at several addresses), in order of adding
+        self._root = [{}, None] # trie node - [children by name part, full name or None]
+        self.macros = set()
+
+        if labels is not None:
+            for addr, addr_labels in labels.items():
+                for label in addr_labels:
+                    self.add(addr, label)
+
+
+    def add(self, addr, name):
+        addrs = self._addrs.get(name)
+        if addrs is None:
+            self._addrs[name] = [addr]
+        else:
+            addrs.append(addr)
+
+        node = self._root
+        for part in name.split('.'):
+            children = node[0]
+            node = children.get(part)
+            if node is None:
+                node = children[part] = [{}, None]
+        node[1] = name
+
+        if '>' in name:
+            self.macros.add(name)
+
+
+    def remove(self, name):
+        """Removes name at all its addresses."""
+
+        del self._addrs[name]
+        self._find_node(name)[1] = None
+        self.macros.discard(name)
+
+
+    def get(self, name, default = None):
+        """Returns list of addresses of name."""
+
+        return self._addrs.get(name, default)
+
+
+    def __contains__(self, name):
+        return name in self._addrs
+
+
+    def __len__(self):
+        return len(self._addrs)
+
+
+    def __iter__(self):
+        return iter(self._addrs)
+
+
+    def items(self):
+        return self._addrs.items()
+
+
+    def is_local(self, name):
+        """Returns True if name is a dotted one and its parent (name without the last part) is a label too."""
+
+        parent = get_parent(name)
+        return parent is not None and parent in self._addrs
+
+
+    def find(self, scope):
+        """Returns names of scope label and of all labels inside it (scope.*)."""
+
+        node = self._find_node(scope)
+        if node is None:
+            return []
+
+        names = []
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if node[1] is not None:
+                names.append(node[1])
+            nodes.extend(node[0].values())
+
+        return names
+
+
+    def to_labels(self):
+        """Returns Labels table of indexed labels (labels at the same address are kept in order of adding)."""
+
+        labels = Labels()
+        for name, addrs in self._addrs.items():
+            for addr in addrs:
+                labels.add(addr, name)
+        return labels
+
+
+    def _find_node(self, name):
+        node = self._root
+        for part in name.split('.'):
+            node = node[0].get(part)
+            if node is None:
+                return None
+        return node
+
+
+def get_parent(name):
+    """Returns name without its last dotted part or None for not dotted name."""
+
+    pos = name.rfind('.')
+    return name[:pos] if pos >= 0 else None
 
 
 def create():
-    return [[] for i in range(0x10000)]
+    return Labels()
 
 
 _pages = ['07', '05', '02', '00']
+_page_indexes = dict((page, index) for index, page in enumerate(_pages))
+_page_indexes[''] = 0
+
+# Line of UnrealSpeccy labels list - "page:offset label", page could be omitted.
+_line = re.compile(r'^[ \t]*([^\s:]*):([0-9A-Fa-f]+)[ \t]+(\S+)[ \t\r]*$', re.M)
+
+_cache_version = 1
 
 
-def load(filename):
+def parse(filename, use_cache = False):
+    """Parses labels list in UnrealSpeccy format reading it in chunks of whole lines.
+
+    Returns (entries, errors): entries - list of (addr, label) in file order, errors - list of (line number, line)
+    for invalid lines. With use_cache results are cached (see cache.py) until file size or modification time changes.
+    """
+
     if not os.path.isfile(filename):
         sys.exit('File "%s" not found.' % filename)
 
-    labels = create()
-
-    for line in open(filename).readlines():
-        line = line.strip()
-        if line:
+    if use_cache:
+        prefix, name = _get_cache_names(filename)
+        data = cache.read(name)
+        if data is not None:
             try:
-                addr, label = line.split()
-                page, addr = [part.strip() for part in addr.split(':')]
+                entries, errors = marshal.loads(data)
+                return entries, errors
+            except (EOFError, ValueError, TypeError):
+                pass
+
+    entries = []
+    errors = []
+
+    with open(filename) as f:
+        line = 1
+        for text in _read_lines(f):
+            _parse_text(text, line, entries, errors)
+            line += text.count('\n')
 
-                page = _pages.index(page) if page else 0
-                addr = int(addr, 16)
+    if use_cache and cache.write(name, marshal.dumps((entries, errors))):
+        for stale in cache.list_names(prefix):
+            if stale != name:
+                cache.remove(stale)
+
+    return entries, errors
+
+
+_CHUNK_SIZE = 1 << 20
+
+def _read_lines(f):
+    # Yields text of f in chunks of whole lines, about _CHUNK_SIZE characters each.
+    rest = ''
+    while True:
+        data = f.read(_CHUNK_SIZE)
+        if not data:
+            if rest:
+                yield rest
+            return
+
+        data = rest + data
+        end = data.rfind('\n') + 1
+        rest = data[end:]
+        if end:
+            yield data[:end]
+
+
+def _parse_text(text, first_line, entries, errors):
+    # Adds entries and errors of text starting at line number first_line.
+    lines = _LineCounter(text, first_line)
+
+    pos = 0
+    for match in _line.finditer(text):
+        start = match.start()
+        if start > pos and not text[pos:start].isspace():
+            _add_errors(errors, lines, text, pos, start)
+
+        page, offset, label = match.groups()
+        page = _page_indexes.get(page)
+        offset = int(offset, 16)
+
+        if page is not None and offset < 0x4000:
+            entries.append((page * 0x4000 + offset, label))
+        else:
+            errors.append((lines.get(start), match.group().strip()))
+
+        pos = match.end()
+
+    if pos < len(text) and not text[pos:].isspace():
+        _add_errors(errors, lines, text, pos, len(text))
+
+
+class _LineCounter:
+    """Converts positions in text to line numbers, positions are expected to grow."""
+
+    def __init__(self, text, line = 1):
+        self.text = text
+        self.pos = 0
+        self.line = line
+
+
+    def get(self, pos):
+        self.line += self.text.count('\n', self.pos, pos)
+        self.pos = pos
+        return self.line
+
+
+def _add_errors(errors, lines, text, org, end):
+    for offset, line in enumerate(text[org:end].split('\n')):
+        if line.strip():
+            errors.append((lines.get(org) + offset, line.strip()))
+
+
+def _get_cache_names(filename):
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+
+    prefix = 'labels-%d-%s-' % (_cache_version, hashlib.sha1(path.encode('utf-8')).hexdigest())
+    return prefix, '%s%d-%d.marshal' % (prefix, st.st_size, st.st_mtime_ns)
+
+
+def load(filename, use_cache = False):
+    labels = create()
 
-                if not 0 <= addr < 0x4000:
-                    raise ValueError()
+    entries, errors = parse(filename, use_cache)
+    for addr, label in entries:
+        labels.add(addr, label)
 
-                addr = page * 0x4000 + addr
-                labels[addr].append(label)
-            except ValueError:
-                sys.stderr.write('Warning: invalid label "%s" in file "%s".\n' % (line, filename))
+    for n, line in errors:
+        warning('invalid-label', 'invalid label "%s" in file "%s".', line, filename)
 
     return labels
 
 
 def save(filename, labels):
     with open(filename, 'w') as f:
-        for addr in range(0x10000):
-            for label in labels[addr]:
+        for addr, addr_labels in labels.items():
+            for label in addr_labels:
                 f.write(_pages[addr // 0x4000])
                 f.write(':')
                 f.write('%04X' % (addr % 0x4000))
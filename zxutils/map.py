@@ -1,6 +1,146 @@
+"""Execution maps in FUSE format - 8K file with a bit per address (bit i % 8 of byte i // 8, LSB first)."""
+
 import sys
 import os
-from struct import unpack
+import re
+
+
+_SIZE = 0x2000
+
+_ones = int.from_bytes(b'\x01' * _SIZE, 'little') # 1 in the lowest bit of every byte
+_bits = [tuple(j for j in range(8) if byte & 1 << j) for byte in range(0x100)] # set bit numbers of every byte value
+_flags = b'\x00' + b'\x01' * 0xFF # translation of any nonzero flag to 1
+_invert = bytes(bytearray(0xFF ^ i for i in range(0x100)))
+_runs = re.compile(b'\x01+')
+
+
+class Bitmap:
+    """Immutable set of addresses in [0, #FFFF] stored as packed FUSE map bytes.
+
+    Set operations (|, &, ^, - for ANDNOT, ~) work on whole maps as big integers, so they cost no per-bit Python work.
+    bitmap[addr] is a bool, iterating yields set addresses in ascending order.
+    """
+
+    def __init__(self, data = None):
+        if data is None:
+            data = bytes(_SIZE)
+        elif len(data) != _SIZE:
+            raise ValueError('Bitmap needs %d bytes, got %d.' % (_SIZE, len(data)))
+
+        self.data = bytes(data)
+
+
+    @classmethod
+    def from_flags(cls, flags):
+        """Packs 64K flags (bytes as returned by CodeAnalyzer.get_exec_map() or list of bools)."""
+
+        flags = bytes(bytearray(flags)).translate(_flags)
+        if len(flags) != 0x10000:
+            raise ValueError('Bitmap needs %d flags, got %d.' % (0x10000, len(flags)))
+
+        # Every eighth flag is a byte of 0/1, so shifting it as a whole number moves each flag to its bit.
+        n = 0
+        for j in range(8):
+            n |= int.from_bytes(flags[j::8], 'little') << j
+
+        return cls._from_int(n)
+
+
+    @classmethod
+    def from_addrs(cls, addrs):
+        data = bytearray(_SIZE)
+        for addr in addrs:
+            data[addr >> 3] |= 1 << (addr & 7)
+
+        return cls(data)
+
+
+    @classmethod
+    def _from_int(cls, n):
+        return cls(n.to_bytes(_SIZE, 'little'))
+
+
+    def _int(self):
+        return int.from_bytes(self.data, 'little')
+
+
+    def to_flags(self):
+        """Returns bytes of #10000 flags (0 or 1) - reverse of from_flags()."""
+
+        n = self._int()
+        flags = bytearray(0x10000)
+        for j in range(8):
+            flags[j::8] = (n >> j & _ones).to_bytes(_SIZE, 'little')
+
+        return bytes(flags)
+
+
+    def __getitem__(self, addr):
+        return self.data[addr >> 3] >> (addr & 7) & 1 != 0
+
+
+    def __iter__(self):
+        bits = _bits
+        for i, byte in enumerate(self.data):
+            if byte:
+                for j in bits[byte]:
+                    yield i << 3 | j
+
+
+    def __bool__(self):
+        return self.data.count(0) != _SIZE
+
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and self.data == other.data
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    __hash__ = None
+
+
+    def __or__(self, other):
+        return Bitmap._from_int(self._int() | other._int())
+
+
+    def __and__(self, other):
+        return Bitmap._from_int(self._int() & other._int())
+
+
+    def __xor__(self, other):
+        return Bitmap._from_int(self._int() ^ other._int())
+
+
+    def __sub__(self, other):
+        return Bitmap._from_int(self._int() & ~other._int())
+
+    andnot = __sub__
+
+
+    def __invert__(self):
+        return Bitmap(self.data.translate(_invert))
+
+
+    def count(self):
+        """Returns number of set addresses."""
+
+        return bin(self._int()).count('1')
+
+
+    def ranges(self):
+        """Returns list of (org, end) ranges of set addresses (end is exclusive)."""
+
+        return [match.span() for match in _runs.finditer(self.to_flags())]
+
+
+
+def as_bitmap(map):
+    """Returns map if it's a Bitmap already, otherwise Bitmap packed from 64K flags."""
+
+    return map if isinstance(map, Bitmap) else Bitmap.from_flags(map)
 
 
 def load(filename):
@@ -8,27 +148,38 @@ def load(filename):
         sys.exit('File "%s" not found.' % filename)
 
     size = os.path.getsize(filename)
-    if size != 0x2000:
+    if size != _SIZE:
         sys.exit('File "%s" is not a valid MAP file.' % filename)
 
-    data = bytearray(open(filename, 'rb').read())
-    return [data[i // 8] & 1 << i % 8 != 0 for i in range(0x10000)]
+    with open(filename, 'rb') as f:
+        return Bitmap(f.read())
 
 
 def merge(maps):
-    if not maps:
-        return [False] * 0x10000
+    """Returns union of maps (any iterable, so maps could be loaded one by one while merging)."""
+
+    n = 0
+    for map in maps:
+        n |= as_bitmap(map)._int()
+
+    return Bitmap._from_int(n)
 
-    map = maps[0]
-    for i in range(1, len(maps)):
-        for j in range(0x10000):
-            if maps[i][j]:
-                map[j] = True
 
-    return map
+def intersect(maps):
+    """Returns intersection of maps (any non-empty iterable, see merge())."""
+
+    n = None
+    for map in maps:
+        n = as_bitmap(map)._int() if n is None else n & as_bitmap(map)._int()
+
+    if n is None:
+        raise ValueError('No maps to intersect.')
+
+    return Bitmap._from_int(n)
 
 
 def save(filename, map):
+    """Saves Bitmap or 64K flags (see Bitmap.from_flags())."""
+
     with open(filename, 'wb') as f:
-        data = bytearray([sum([1 << j if map[i * 8 + j] else 0 for j in range(8)]) for i in range(0x2000)])
-        f.write(data)
+        f.write(as_bitmap(map).data)
@@ -1,9 +1,11 @@
-import sys
+from struct import Struct, unpack_from
+
+from .diagnostics import warning
 
 
 def wrap(addr):
     if addr >= 0x10000:
-        sys.stderr.write('Warning: memory address is #%X - wrapped to #%04X.\n' % (addr, addr % 0x10000))
+        warning('wrap', 'memory address is #%X - wrapped to #%04X.', addr, addr % 0x10000)
         addr %= 0x10000
     return addr
 
@@ -11,7 +13,7 @@ def wrap(addr):
 def get_byte(ram, addr):
     addr = wrap(addr)
     if addr < 0x4000:
-        sys.stderr.write('Warning: accessing rom memory at #%04X - returning 0.\n' % (addr, new_addr))
+        warning('rom', 'accessing rom memory at #%04X - returning 0.', addr)
         return 0
     return ram[addr - 0x4000]
 
@@ -23,3 +25,96 @@ def get_sbyte(ram, addr):
 
 def get_word(ram, addr):
     return get_byte(ram, addr) + 256 * get_byte(ram, addr + 1)
+
+
+_TAIL = 4 # longest instruction size - bytes after #FFFF mirroring #0000.. so reads can wrap around without checks
+
+_word = Struct('<H')
+
+
+class AddressSpace:
+    """Flat 64K view of Spectrum memory backed by one buffer.
+
+    ROM area is zero-filled or loaded from a ROM image, RAM is mapped in place - ram attribute is a writable
+    memoryview of #4000..#FFFF, so loaders can read RAM straight into it. Accessors take addresses in
+    [0, #FFFF] and do no checks: reads of up to 4 bytes past #FFFF wrap around to #0000.
+    """
+
+    def __init__(self, ram = None, rom = None):
+        self.buffer = bytearray(0x10000 + _TAIL)
+        self.view = memoryview(self.buffer)
+        self.ram = self.view[0x4000:0x10000]
+
+        if rom is not None:
+            self.view[0:len(rom)] = rom
+            self.view[0x10000:] = self.view[0:_TAIL]
+        if ram is not None:
+            self.ram[0:len(ram)] = ram
+
+
+    def __len__(self):
+        return 0x10000
+
+
+    def __getitem__(self, index):
+        return self.view[index] if type(index) is slice else self.buffer[index]
+
+
+    def byte(self, addr):
+        return self.buffer[addr]
+
+
+    def sbyte(self, addr):
+        return (self.buffer[addr] ^ 0x80) - 0x80
+
+
+    def word(self, addr):
+        return _word.unpack_from(self.buffer, addr)[0]
+
+
+    def words(self, addr, count):
+        """Returns tuple of count words starting at addr (addr + 2 * count must not exceed #10000)."""
+
+        return unpack_from('<%dH' % count, self.buffer, addr)
+
+
+def as_address_space(memory):
+    """Returns memory if it's an AddressSpace already, otherwise AddressSpace with a copy of memory as RAM."""
+
+    return memory if isinstance(memory, AddressSpace) else AddressSpace(memory)
+
+
+class PagedMemory:
+    """128K memory - eight 16K RAM banks paged according to port #7FFD.
+
+    Banks are kept as given (e.g. memoryview slices of a mapped snapshot file), nothing is copied until
+    get_address_space() builds a flat 64K view of one bank configuration: bank 5 at #4000, bank 2 at #8000
+    and the selected bank at #C000.
+    """
+
+    def __init__(self, banks, port_7ffd = 0):
+        if len(banks) != 8 or any(len(bank) != 0x4000 for bank in banks):
+            raise ValueError('PagedMemory needs eight 16K banks.')
+
+        self.banks = banks
+        self.port_7ffd = port_7ffd
+
+
+    @property
+    def paged_bank(self):
+        """Bank paged at #C000 by port #7FFD."""
+
+        return self.port_7ffd & 7
+
+
+    def get_address_space(self, bank = None, rom = None):
+        """Returns AddressSpace with given bank (paged one by default) at #C000."""
+
+        if bank is None:
+            bank = self.paged_bank
+
+        mem = AddressSpace(rom = rom)
+        mem.ram[0x0000:0x4000] = self.banks[5]
+        mem.ram[0x4000:0x8000] = self.banks[2]
+        mem.ram[0x8000:0xC000] = self.banks[bank]
+        return mem
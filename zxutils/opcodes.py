@@ -1401,3 +1401,66 @@ for table in opcodes[0xDD], opcodes[0xFD]: # IX & IY
             op['args'] = [{'pos': 2, 'size': 1, 'signed': True}] # IX+d & IY+d
 
     table[0x36]['args'] = [{'pos': 2, 'size': 1, 'signed': True}, {'pos': 3, 'size': 1}] # LD (IX+d),n & LD (IY+d),n
+
+
+# Flow: (continues to the next instruction, jump - False, 'absolute', 'relative', 'indirect', 'return' or RST address).
+
+opcodes[0x10]['flow'] = (True , 'relative') # DJNZ nn
+
+opcodes[0x18]['flow'] = (False, 'relative') # JR nn
+opcodes[0x38]['flow'] = (True , 'relative') # JR C,nn
+opcodes[0x30]['flow'] = (True , 'relative') # JR NC,nn
+opcodes[0x28]['flow'] = (True , 'relative') # JR Z,nn
+opcodes[0x20]['flow'] = (True , 'relative') # JR NZ,nn
+
+opcodes[0xC3]['flow'] = (False, 'absolute') # JP nn
+opcodes[0xDA]['flow'] = (True , 'absolute') # JP C,nn
+opcodes[0xD2]['flow'] = (True , 'absolute') # JP NC,nn
+opcodes[0xCA]['flow'] = (True , 'absolute') # JP Z,nn
+opcodes[0xC2]['flow'] = (True , 'absolute') # JP NZ,nn
+opcodes[0xF2]['flow'] = (True , 'absolute') # JP P,nn
+opcodes[0xFA]['flow'] = (True , 'absolute') # JP M,nn
+opcodes[0xE2]['flow'] = (True , 'absolute') # JP PO,nn
+opcodes[0xEA]['flow'] = (True , 'absolute') # JP PE,nn
+opcodes[0xE9]['flow'] = (False, 'indirect') # JP (HL)
+
+opcodes[0xCD]['flow'] = (True , 'absolute') # CALL nn
+opcodes[0xDC]['flow'] = (True , 'absolute') # CALL C,nn
+opcodes[0xD4]['flow'] = (True , 'absolute') # CALL NC,nn
+opcodes[0xCC]['flow'] = (True , 'absolute') # CALL Z,nn
+opcodes[0xC4]['flow'] = (True , 'absolute') # CALL NZ,nn
+opcodes[0xF4]['flow'] = (True , 'absolute') # CALL P,nn
+opcodes[0xFC]['flow'] = (True , 'absolute') # CALL M,nn
+opcodes[0xE4]['flow'] = (True , 'absolute') # CALL PO,nn
+opcodes[0xEC]['flow'] = (True , 'absolute') # CALL PE,nn
+
+opcodes[0xC9]['flow'] = (False, 'return') # RET
+opcodes[0xD8]['flow'] = (True , 'return') # RET C
+opcodes[0xD0]['flow'] = (True , 'return') # RET NC
+opcodes[0xC8]['flow'] = (True , 'return') # RET Z
+opcodes[0xC0]['flow'] = (True , 'return') # RET NZ
+opcodes[0xF0]['flow'] = (True , 'return') # RET P
+opcodes[0xF8]['flow'] = (True , 'return') # RET M
+opcodes[0xE0]['flow'] = (True , 'return') # RET PO
+opcodes[0xE8]['flow'] = (True , 'return') # RET PE
+
+opcodes[0xC7]['flow'] = (True , 0x00) # RST 00h
+opcodes[0xCF]['flow'] = (True , 0x08) # RST 08h
+opcodes[0xD7]['flow'] = (True , 0x10) # RST 10h
+opcodes[0xDF]['flow'] = (True , 0x18) # RST 18h
+opcodes[0xE7]['flow'] = (True , 0x20) # RST 20h
+opcodes[0xEF]['flow'] = (True , 0x28) # RST 28h
+opcodes[0xF7]['flow'] = (True , 0x30) # RST 30h
+opcodes[0xFF]['flow'] = (True , 0x38) # RST 38h
+
+opcodes[0xED][0x4D]['flow'] = (False, 'return') # RETI
+opcodes[0xED][0x45]['flow'] = (False, 'return') # RETN
+opcodes[0xED][0x55]['flow'] = (False, 'return') # RETN
+opcodes[0xED][0x5D]['flow'] = (False, 'return') # RETN
+opcodes[0xED][0x65]['flow'] = (False, 'return') # RETN
+opcodes[0xED][0x6D]['flow'] = (False, 'return') # RETN
+opcodes[0xED][0x75]['flow'] = (False, 'return') # RETN
+opcodes[0xED][0x7D]['flow'] = (False, 'return') # RETN
+
+opcodes[0xDD][0xE9]['flow'] = (False, 'indirect') # JP (IX)
+opcodes[0xFD][0xE9]['flow'] = (False, 'indirect') # JP (IY)
@@ -0,0 +1,48 @@
+import sys
+
+
+class Output:
+    """Line-oriented text sink: collects whole lines and writes them to file (stdout by default)
+    in chunks of about buffer_size characters. Call flush() when done.
+    """
+
+    def __init__(self, file = None, buffer_size = 1 << 16):
+        self.file = file if file is not None else sys.stdout
+        self.buffer_size = buffer_size
+
+        self._lines = []
+        self._size = 0
+
+
+    def line(self, text = ''):
+        self._lines.append(text)
+        self._size += len(text) + 1
+
+        if self._size >= self.buffer_size:
+            self._write()
+
+
+    def lines(self, texts):
+        for text in texts:
+            self.line(text)
+
+
+    def write(self, text):
+        """Writes text of whole lines (ending with newline) after the buffered ones."""
+
+        self._write()
+        self.file.write(text)
+
+
+    def flush(self):
+        self._write()
+        self.file.flush()
+
+
+    def _write(self):
+        if self._lines:
+            self._lines.append('')
+            self.file.write('\n'.join(self._lines))
+
+            self._lines = []
+            self._size = 0
@@ -1,35 +1,142 @@
 import sys
 import os
-from struct import unpack
+import mmap
+from struct import Struct
+
+from .memory import AddressSpace, PagedMemory
 
 
 _types = {0xC01B: 48, 0x2001F: 128, 0x2401F: 128}
 
+prop_names = ('I', "HL'", "DE'", "BC'", "AF'", 'HL', 'DE', 'BC', 'IY', 'IX', 'INT_FLAGS', 'R', 'AF', 'SP', 'INT_MODE', 'BORDER', 'PC', '7FFD', 'TRDOS_ROM')
+prop_sizes = ( 1,   2,     2,     2,     2,     2,    2,    2,    2,    2,    1,           1,   2,    2,    1,          1,        2,    1,      1         )
+
+header = Struct('<BHHHHHHHHHBBHHBB') # properties from I to BORDER
+trailer = Struct('<HBB') # 128k only: PC, 7FFD & TRDOS_ROM
+
+_TRAILER_POS = 0xC01B
+_word = Struct('<H')
+
+
+class Snapshot:
+    """SNA file mapped into memory.
+
+    Header and 128k trailer are parsed on first access. RAM (#4000..#FFFF as stored in the file) is a read-only
+    memoryview of the mapped file until patch() replaces it with a private copy.
+    """
+
+    def __init__(self, filename):
+        if not os.path.isfile(filename):
+            sys.exit('File "%s" not found.' % filename)
+
+        size = os.path.getsize(filename)
+        if size not in _types:
+            sys.exit('File "%s" is not a valid SNA file.' % filename)
+
+        self.filename = filename
+        self.type = _types[size]
+
+        with open(filename, 'rb') as f:
+            self.data = memoryview(mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ))
+
+        self.ram = self.data[header.size:_TRAILER_POS]
+        self._props = None
+
+
+    def get_props(self):
+        """Returns dict of properties named as in prop_names as stored in the file.
+
+        For 48k snapshots SP is the value after PC is popped from the stack, PC is None if SP is out of RAM
+        and 7FFD & TRDOS_ROM are None.
+        """
+
+        if self._props is None:
+            props = dict(zip(prop_names, header.unpack_from(self.data, 0)))
+
+            if self.type == 48:
+                sp = props['SP']
+                props['PC'] = _word.unpack_from(self.data, header.size + sp - 0x4000)[0] if 0x4000 <= sp <= 0xFFFE else None
+                props['SP'] = (sp + 2) % 0x10000
+                props['7FFD'] = props['TRDOS_ROM'] = None
+            else:
+                props['PC'], props['7FFD'], props['TRDOS_ROM'] = trailer.unpack_from(self.data, _TRAILER_POS)
+
+            self._props = props
+
+        return dict(self._props)
+
+
+    @property
+    def pc(self):
+        return self.get_props()['PC']
+
+
+    @property
+    def sp(self):
+        return self.get_props()['SP']
+
+
+    def patch(self, addr, data):
+        """Writes data into RAM at addr in [#4000, #FFFF], RAM is copied from the file on the first patch."""
+
+        if self.ram.readonly:
+            self.ram = memoryview(bytearray(self.ram))
+
+        self.ram[addr - 0x4000:addr - 0x4000 + len(data)] = data
+
+
+    def get_banks(self):
+        """Returns PagedMemory of 128k snapshot (banks are slices of RAM and of the mapped file) or None for 48k one."""
+
+        if self.type == 48:
+            return None
+
+        port_7ffd = self.get_props()['7FFD']
+        banks = _get_banks(self.data, self.ram, port_7ffd & 7)
+        if banks is None:
+            sys.exit('File "%s" is not a valid SNA file - banks don\'t match port #7FFD value #%02X.' % (self.filename, port_7ffd))
+
+        return PagedMemory(banks, port_7ffd)
+
+
+    def get_memory(self, bank = None):
+        """Returns AddressSpace with a copy of RAM, for 128k snapshots - with given bank (paged one by default) at #C000."""
+
+        if self.type == 48:
+            if bank is not None:
+                sys.exit('Can\'t select bank %d in 48k snapshot "%s".' % (bank, self.filename))
+            return AddressSpace(self.ram)
+
+        return self.get_banks().get_address_space(bank)
+
+
+def _get_banks(data, ram, paged_bank):
+    # 128k layout: header, banks 5, 2 and the paged one, trailer, then the remaining banks in ascending order
+    # (bank paged at #C000 is stored twice if it's 5 or 2).
+    banks = [None] * 8
+    banks[5] = ram[0x0000:0x4000]
+    banks[2] = ram[0x4000:0x8000]
+    banks[paged_bank] = ram[0x8000:0xC000]
 
-def load(filename):
-    if not os.path.isfile(filename):
-        sys.exit('File "%s" not found.' % filename)
+    offset = _TRAILER_POS + trailer.size
+    for n in range(8):
+        if n not in (5, 2, paged_bank):
+            banks[n] = data[offset:offset + 0x4000]
+            offset += 0x4000
 
-    size = os.path.getsize(filename)
-    if size not in _types:
-        sys.exit('File "%s" is not a valid SNA file.' % filename)
+    return banks if offset == len(data) else None
 
-    with open(filename, 'rb') as f:
-        type = _types[size]
 
-        f.seek(23)
-        sp, = unpack('<H', f.read(2))
+def load(filename, bank = None):
+    """Loads SNA file into dict of type, memory (AddressSpace, see Snapshot.get_memory()), ram, banks, port_7ffd, pc & sp."""
 
-        f.seek(27)
-        ram = bytearray(f.read(0xC000))
+    snapshot = Snapshot(filename)
+    props = snapshot.get_props()
 
-        if type == 48:
-            if not 0x4000 <= sp <= 0xFFFC:
-                sys.exit('Can\'t load file "%s" - SP is out of RAM.' % filename)
+    if props['PC'] is None:
+        sys.exit('Can\'t load file "%s" - SP is out of RAM.' % filename)
 
-            pc = ram[sp - 0x4000] + ram[sp + 1 - 0x4000] * 256
-            sp += 2
-        else:
-            pc, = unpack('<H', f.read(2))
+    mem = snapshot.get_memory(bank)
 
-        return {'type': type, 'ram': ram, 'pc': pc, 'sp': sp}
+    return {'type': snapshot.type, 'memory': mem, 'ram': mem.ram, 'banks': snapshot.get_banks(),
+            'port_7ffd': props['7FFD'], 'pc': props['PC'], 'sp': props['SP']}
@@ -0,0 +1,186 @@
+"""Decode tables built from opcodes.py.
+
+Building them means executing opcodes.py and post-processing ~1500 opcodes, so finished tables
+are cached in marshal format (see cache.py) and rebuilt only when opcodes.py changes.
+
+Tables are (tables, skips):
+tables[0] is the unprefixed table, the others are CB, DD, DDCB, ED, FD & FDCB ones.
+Entry is either an opcode, None for an invalid one or an index of the next table for prefixes.
+skips[index] is the number of bytes (displacement) preceding the opcode byte in the prefixed table.
+
+Opcodes are Instruction records converted from opcodes.py dicts.
+"""
+
+import os
+import sys
+import marshal
+from collections import namedtuple
+
+from . import cache
+
+
+# Argument slot types of compiled formats.
+SLOT_BYTE   = 0
+SLOT_WORD   = 1 # word or address (including relative one) - could be replaced by a label
+SLOT_SIGNED = 2 # IX/IY displacement
+
+_VERSION = 4
+
+
+Operand = namedtuple('Operand', 'pos size signed relative')
+Operand.__doc__ = """Instruction argument: position in instruction, size, IX/IY displacement flag, JR/DJNZ offset flag."""
+Operand.__new__.__defaults__ = (False, False)
+
+Instruction = namedtuple('Instruction', 'size asm args flow mnemonic operands')
+Instruction.__doc__ = """Opcode record:
+size     - instruction size
+asm      - asm template, '%' is replaced with arguments
+args     - tuple of Operands
+flow     - (continues to the next instruction, jump) - see opcodes.py
+mnemonic - asm template up to the first space
+operands - compiled templates of comma separated operands, (parts, slots) each:
+           literal parts of the operand and SLOT_* types of the arguments between them (taken from args in order)
+"""
+Instruction.__new__.__defaults__ = ((), (True, False), None, None)
+
+
+def _flatten(root):
+    tables = []
+    skips = []
+
+    def add(table):
+        index = len(tables)
+        flat = list(table[0:256])
+        tables.append(flat)
+        skips.append(table[256])
+
+        for code, op in enumerate(flat):
+            if type(op) is list:
+                flat[code] = add(op)
+
+        return index
+
+    add(root)
+    return tables, skips
+
+
+def _compile_format(op):
+    slots = []
+    for arg in op.get('args', ()):
+        if arg['size'] == 2 or arg.get('relative'):
+            slots.append(SLOT_WORD)
+        elif arg.get('signed'):
+            slots.append(SLOT_SIGNED)
+        else:
+            slots.append(SLOT_BYTE)
+
+    mnemonic, _, operands = op['asm'].partition(' ')
+
+    templates = []
+    for operand in operands.split(',') if operands else ():
+        parts = operand.split('%')
+        templates.append((tuple(parts), tuple(slots[:len(parts) - 1])))
+        del slots[:len(parts) - 1]
+
+    return mnemonic, tuple(templates)
+
+
+def _make_instruction(op, operands):
+    args = []
+    for arg in op.get('args', ()):
+        arg = Operand(arg['pos'], arg['size'], arg.get('signed', False), arg.get('relative', False))
+        args.append(operands.setdefault(arg, arg)) # sharing equal operands
+
+    mnemonic, operands = _compile_format(op)
+    return Instruction(op['size'], op['asm'], tuple(args), op.get('flow', (True, False)), mnemonic, operands)
+
+
+def build():
+    from .opcodes import opcodes
+
+    tables, skips = _flatten(opcodes)
+
+    operands = {}
+    for table in tables:
+        for code, op in enumerate(table):
+            if type(op) is dict:
+                table[code] = _make_instruction(op, operands)
+
+    return tables, skips
+
+
+# Marshal supports plain tuples only, so records are stored as tuples and restored on load.
+
+def _dump(tables):
+    tables, skips = tables
+
+    plain = []
+    for table in tables:
+        plain.append([op if type(op) is not Instruction else
+                      (op.size, op.asm, tuple(tuple(arg) for arg in op.args), op.flow, op.mnemonic, op.operands) for op in table])
+
+    return marshal.dumps((plain, skips))
+
+
+def _restore(data):
+    tables, skips = marshal.loads(data)
+
+    operands = {}
+    for table in tables:
+        for code, op in enumerate(table):
+            if type(op) is tuple:
+                size, asm, args, flow, mnemonic, templates = op
+
+                for arg in args:
+                    if arg not in operands:
+                        operands[arg] = Operand(*arg)
+
+                table[code] = Instruction(size, asm, tuple([operands[arg] for arg in args]), flow, mnemonic, templates)
+
+    return tables, skips
+
+
+def _get_cache_prefix():
+    return 'tables-%d-py%d%d-' % (_VERSION, sys.version_info[0], sys.version_info[1])
+
+
+def _get_cache_name():
+    st = os.stat(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opcodes.py'))
+    return _get_cache_prefix() + '%d-%d.marshal' % (st.st_size, int(st.st_mtime))
+
+
+def get_signature():
+    """Returns string identifying the tables - it changes with them (e.g. when opcodes.py is edited)."""
+
+    try:
+        return _get_cache_name()
+    except OSError:
+        return 'tables-%d' % _VERSION
+
+
+def load():
+    """Returns tables from cache, building and caching them if needed."""
+
+    try:
+        name = _get_cache_name()
+    except OSError: # no opcodes.py source (e.g. frozen package)
+        return build()
+
+    data = cache.read(name)
+    if data is not None:
+        try:
+            return _restore(data)
+        except (EOFError, ValueError, TypeError, IndexError):
+            pass
+
+    tables = build()
+    if cache.write(name, _dump(tables)):
+        _remove_stale(name)
+    return tables
+
+
+def _remove_stale(name):
+    # Only tables of this version built by this Python are replaced - other ones may be still in use.
+    for stale in cache.list_names(_get_cache_prefix()):
+        if stale != name:
+            cache.remove(stale)